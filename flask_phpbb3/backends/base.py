@@ -1,14 +1,122 @@
 from __future__ import absolute_import
 
+import array
+import base64
+import functools
+import hashlib
+import json
+import threading
+import time
 import typing
+import uuid
+
+import flask_phpbb3.cache
 
 import werkzeug.contrib.cache
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 ACL_OPTIONS_CACHE_TTL = 3600 * 1
+# How often cached ACL options are checked for changes
+ACL_OPTIONS_REFRESH_INTERVAL = 60
+CACHE_LOCK_POLL_INTERVAL = 0.05
+
+# User permissions are base 36 chunks of 6 characters, each holds 31 bits
+ACL_CHUNK_SIZE = 6
+ACL_CHUNK_BITS = 31
+ACL_TYPECODE = 'I' if array.array('I').itemsize >= 4 else 'L'
+USER_ACL_CACHE_SIZE = 1024
+
+# Process wide locks, so only one thread loads a missing cache key
+_cache_key_locks = flask_phpbb3.cache.KeyLocks()
+# Lease of callers, when locking through cache is disabled
+_NO_LEASE = ''
+_serializers = {}\
+    # type: typing.Dict[tuple, flask_phpbb3.cache.Serializer]
+# Parsed user ACLs, users in same groups share permissions
+_user_acls = flask_phpbb3.cache.LocalCache(USER_ACL_CACHE_SIZE)
+# Process wide ACL option indexes, as (index, checked at) per database
+_acl_options = {}\
+    # type: typing.Dict[tuple, typing.Tuple[AclOptions, float]]
+_acl_options_lock = threading.Lock()
+
+
+def _to_bytes(value):
+    # type: (typing.Union[bytes, typing.Text]) -> bytes
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _copy_result(value):
+    # type: (typing.Any) -> typing.Any
+    """Shallow copies rows of a result, so callers can not alter others."""
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [dict(row) if isinstance(row, dict) else row for row in value]
+    return value
+
+
+def encode_page_cursor(value):
+    # type: (typing.Any) -> str
+    """Encodes last seen sort key into an opaque cursor."""
+    data = _to_bytes(json.dumps([value], separators=(',', ':')))
+    return str(base64.urlsafe_b64encode(data).decode('ascii').rstrip('='))
+
+
+def decode_page_cursor(cursor):
+    # type: (str) -> typing.Any
+    try:
+        data = base64.urlsafe_b64decode(
+            _to_bytes(cursor) + b'=' * (-len(cursor) % 4)
+        )
+        value, = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid page cursor {}'.format(cursor))
+    return value
+
+
+class Statement(object):
+    """SQL statement with table prefix rendered, ready to be executed."""
+    __slots__ = ('name', 'operation', 'query', 'version')
+
+    def __init__(self, name, query, table_prefix):
+        # type: (str, str, str) -> None
+        self.name = name
+        self.operation = name.split('_')[0]
+        self.query = query.format(TABLE_PREFIX=table_prefix)
+
+        # Changes whenever query changes, used in cache keys
+        self.version = hashlib.sha1(_to_bytes(self.query)).hexdigest()[:8]
+
+
+class StatementRegistry(Mapping):
+    """Immutable mapping of statement names to compiled statements."""
+    def __init__(self, statements):
+        # type: (typing.Dict[str, typing.Any]) -> None
+        self._statements = statements
+
+    def __getitem__(self, name):
+        # type: (str) -> typing.Any
+        return self._statements[name]
+
+    def __iter__(self):
+        # type: () -> typing.Iterator[str]
+        return iter(self._statements)
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._statements)
 
 
 class BaseBackend(object):
+    statement_class = Statement
     KNOWN_OPERATIONS = (
+        'batch',
         'fetch',
         'get',
         'has',
@@ -17,30 +125,77 @@ class BaseBackend(object):
     KNOWN_DRIVERS = (
         'psycopg2',
     )
+    # Read operations, which are executed once per backend (app context)
+    MEMOIZED_OPERATIONS = (
+        'batch',
+        'fetch',
+        'get',
+        'has',
+    )
 
     def __init__(
         self,
         cache,  # type: werkzeug.contrib.cache.BaseCache
-        config  # type: typing.Dict[str, str]
+        config,  # type: typing.Dict[str, typing.Any]
+        statements=None,  # type: typing.Optional[StatementRegistry]
     ):
         # type: (...) -> None
-        self._functions = {}  # type: typing.Dict[str, str]
         self._connection = None
         self._cache = cache
         self._config = config
+        self._memo = {}  # type: typing.Dict[str, typing.Any]
 
-        self._prepare_statements()
-        custom_statements = self._config.get('CUSTOM_STATEMENTS', {})
+        if statements is None:
+            statements = self.create_registry(config)
+        self._functions = statements
+
+    @classmethod
+    def create_registry(cls, config):
+        # type: (typing.Dict[str, typing.Any]) -> StatementRegistry
+        """Builds and validates all statements, meant to be shared."""
+        functions = cls._prepare_statements(config)
+        custom_statements = config.get('CUSTOM_STATEMENTS', {})
         if not isinstance(custom_statements, dict):
             custom_statements = {}
-        self._functions.update(custom_statements)
+        functions.update(custom_statements)
+
+        cls._compile_statements(functions, config)
+        return StatementRegistry(functions)
+
+    @classmethod
+    def _compile_statements(cls, functions, config):
+        # type: (typing.Dict[str, typing.Any], typing.Dict[str, str]) -> None
+        """Renders all SQL statements once, callables are left as they are."""
+        for name, query in list(functions.items()):
+            if callable(query):
+                continue
+
+            operation = name.split('_')[0]
+            if operation not in cls.KNOWN_OPERATIONS:
+                raise ValueError(
+                    'Statement {name} has unknown prefix {prefix}_,'
+                    ' expected one of: {known}'.format(
+                        name=name,
+                        prefix=operation,
+                        known=', '.join(
+                            i + '_' for i in cls.KNOWN_OPERATIONS
+                        ),
+                    )
+                )
+
+            functions[name] = cls.statement_class(
+                name,
+                query,
+                config['TABLE_PREFIX'],
+            )
 
     def _setup_connection(self):
         # type: () -> None
         raise NotImplementedError
 
-    def _prepare_statements(self):
-        # type: () -> None
+    @classmethod
+    def _prepare_statements(cls, config):
+        # type: (typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]
         raise NotImplementedError
 
     @property
@@ -58,6 +213,346 @@ class BaseBackend(object):
         # type: (...) -> typing.Any
         raise NotImplementedError
 
+    def stream(
+        self,
+        command,  # type: str
+        skip=0,  # type: int
+        limit=None,  # type: typing.Optional[int]
+        **kwargs  # type: typing.Any
+    ):
+        # type: (...) -> typing.Iterator[dict]
+        """
+        Yields rows of fetch_ command one by one, without holding the whole
+        result in memory. Results are never cached.
+        """
+        raise NotImplementedError
+
+    def _memoized(
+        self,
+        command,  # type: str
+        kwargs,  # type: typing.Dict[str, typing.Any]
+        skip,  # type: int
+        limit,  # type: typing.Optional[int]
+        loader,  # type: typing.Callable
+    ):
+        # type: (...) -> typing.Any
+        """
+        Returns result of a read statement loaded once per backend, writes
+        forget all memoized results.
+        """
+        operation = getattr(self._functions.get(command), 'operation', None)
+        if operation not in self.MEMOIZED_OPERATIONS:
+            self._memo.clear()
+            return loader()
+        if not self._config.get('MEMOIZE', True):
+            return loader()
+
+        memo_key = self._try_cache_key(command, kwargs, skip, limit)
+        if memo_key is None:
+            return loader()
+        try:
+            return _copy_result(self._memo[memo_key])
+        except KeyError:
+            output = loader()
+            self._memo[memo_key] = _copy_result(output)
+            return output
+
+    def _cache_key(
+        self,
+        command,  # type: str
+        kwargs,  # type: typing.Dict[str, typing.Any]
+        skip=0,  # type: int
+        limit=10,  # type: typing.Optional[int]
+    ):
+        # type: (...) -> str
+        statement = self._functions.get(command)
+        if getattr(statement, 'operation', None) == 'fetch':
+            # Every page is cached on its own
+            kwargs = dict(kwargs, _skip=skip, _limit=limit)
+
+        return flask_phpbb3.cache.make_key(
+            command,
+            kwargs,
+            getattr(statement, 'version', None),
+        )
+
+    def _try_cache_key(
+        self,
+        command,  # type: str
+        kwargs,  # type: typing.Dict[str, typing.Any]
+        skip=0,  # type: int
+        limit=10,  # type: typing.Optional[int]
+    ):
+        # type: (...) -> typing.Optional[str]
+        """Returns cache key, None if arguments can not be part of one."""
+        try:
+            return self._cache_key(command, kwargs, skip, limit)
+        except TypeError:
+            return None
+
+    @property
+    def _serializer(self):
+        # type: () -> flask_phpbb3.cache.Serializer
+        settings = (
+            self._config.get('CACHE_SERIALIZER', 'pickle'),
+            self._config.get('CACHE_COMPRESSION'),
+            self._config.get('CACHE_COMPRESS_THRESHOLD', 1024),
+        )
+        serializer = _serializers.get(settings)
+        if serializer is None:
+            serializer = _serializers[settings] =\
+                flask_phpbb3.cache.Serializer(*settings)
+        return serializer
+
+    def _cache_get(self, cache_key):
+        # type: (str) -> typing.Optional[typing.Tuple[typing.Any, bool]]
+        """Returns cached value and whether it is still fresh."""
+        raw_data = self._cache.get(cache_key)
+        if not raw_data or not isinstance(raw_data, bytes):
+            return None
+
+        try:
+            fresh_until, output = self._serializer.loads(raw_data)
+        except Exception:
+            # Woops :S Corrupted or written by an incompatible worker
+            return None
+
+        return output, fresh_until is None or fresh_until > time.time()
+
+    def _cache_set(self, cache_key, output, cache_ttl):
+        # type: (str, typing.Any, typing.Optional[int]) -> None
+        if cache_ttl is None:
+            cache_ttl = getattr(self._cache, 'default_timeout', 300)
+
+        # Entries are kept past their TTL to be served while refreshed
+        fresh_until = None
+        timeout = 0
+        if cache_ttl:
+            fresh_until = time.time() + cache_ttl
+            timeout = cache_ttl + self._config.get('CACHE_STALE_TTL', 0)
+
+        try:
+            data = self._serializer.dumps([fresh_until, output])
+        except (TypeError, ValueError):
+            # Woops :S Value can not be serialized, so it is not cached
+            return
+        self._cache.set(cache_key, data, timeout)
+
+    def _acquire_lease(self, cache_key):
+        # type: (str) -> typing.Optional[str]
+        """
+        Acquires a lock, shared by all processes using the cache. Returns
+        token of the lease, None if somebody else holds it.
+        """
+        lock_ttl = self._config.get('CACHE_LOCK_TTL', 0)
+        if not lock_ttl:
+            return _NO_LEASE
+
+        token = uuid.uuid4().hex
+        if not self._cache.add(cache_key + ':lock', token, lock_ttl):
+            return None
+        return token
+
+    def _release_lease(self, cache_key, token):
+        # type: (str, str) -> None
+        if token == _NO_LEASE:
+            return
+
+        # Lease might have expired and been taken by somebody else
+        if self._cache.get(cache_key + ':lock') == token:
+            self._cache.delete(cache_key + ':lock')
+
+    def _wait_for_lease(self, cache_key):
+        # type: (str) -> typing.Optional[typing.Tuple[typing.Any, bool]]
+        """Waits for other process to fill the cache or give up the lock."""
+        deadline = time.time() + self._config.get('CACHE_LOCK_TTL', 0)
+        while time.time() < deadline:
+            time.sleep(CACHE_LOCK_POLL_INTERVAL)
+
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                return cached
+            if self._cache.get(cache_key + ':lock') is None:
+                break
+        return None
+
+    def _load_and_cache(self, cache_key, cache_ttl, loader):
+        # type: (str, typing.Optional[int], typing.Callable) -> typing.Any
+        output = loader()
+        self._cache_set(cache_key, output, cache_ttl)
+        return output
+
+    def _cached(self, cache_key, cache_ttl, loader):
+        # type: (str, typing.Optional[int], typing.Callable) -> typing.Any
+        """
+        Returns cached result of loader, which is called only once per key,
+        no matter how many threads or processes miss it at the same time.
+        """
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            output, fresh = cached
+            if fresh:
+                return output
+
+            # Stale, only the lease holder refreshes it, others serve it
+            with _cache_key_locks.lock(cache_key, blocking=False) as locked:
+                if not locked:
+                    return output
+
+                token = self._acquire_lease(cache_key)
+                if token is None:
+                    return output
+                try:
+                    return self._load_and_cache(cache_key, cache_ttl, loader)
+                finally:
+                    self._release_lease(cache_key, token)
+
+        with _cache_key_locks.lock(cache_key):
+            # Some other thread might have already loaded it
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                return cached[0]
+
+            token = self._acquire_lease(cache_key)
+            if token is not None:
+                try:
+                    return self._load_and_cache(cache_key, cache_ttl, loader)
+                finally:
+                    self._release_lease(cache_key, token)
+
+            # Other process is loading it
+            cached = self._wait_for_lease(cache_key)
+            if cached is not None:
+                return cached[0]
+            return self._load_and_cache(cache_key, cache_ttl, loader)
+
+    def execute_batch(
+        self,
+        command,  # type: str
+        key,  # type: str
+        values,  # type: typing.Iterable[typing.Any]
+        cache=False,  # type: bool
+        cache_ttl=None,  # type: typing.Optional[int]
+    ):
+        # type: (...) -> typing.Dict[typing.Any, dict]
+        """
+        Executes get_ command for multiple values of key at once, using
+        batch_ variant of it. Results are cached as if command was executed
+        for each value.
+        """
+        output = {}  # type: typing.Dict[typing.Any, dict]
+        missing = []  # type: typing.List[typing.Any]
+        for value in values:
+            if value in output or value in missing:
+                continue
+
+            cache_key = None
+            if cache:
+                cache_key = self._try_cache_key(command, {key: value})
+            if cache_key is not None:
+                cached = self._cache_get(cache_key)
+                if cached is not None and cached[1]:
+                    if cached[0] is not None:
+                        output[value] = cached[0]
+                    continue
+            missing.append(value)
+
+        if not missing:
+            return output
+
+        batch_kwargs = {key: missing}  # type: typing.Dict[str, typing.Any]
+        rows = self.execute('batch_' + command, **batch_kwargs)
+        rows_by_key = dict((row[key], row) for row in rows or [])
+        for value in missing:
+            row = rows_by_key.get(value)
+            cache_key = None
+            if cache:
+                cache_key = self._try_cache_key(command, {key: value})
+            if cache_key is not None:
+                self._cache_set(cache_key, row, cache_ttl)
+            if row is not None:
+                output[value] = row
+
+        return output
+
+    def execute_page(
+        self,
+        command,  # type: str
+        key,  # type: str
+        cursor=None,  # type: typing.Optional[str]
+        limit=10,  # type: int
+        cache=False,  # type: bool
+        cache_ttl=None,  # type: typing.Optional[int]
+        **kwargs  # type: typing.Any
+    ):
+        # type: (...) -> typing.Tuple[typing.List[dict], typing.Optional[str]]
+        """
+        Executes fetch_ command, paginated by key instead of an offset.
+        Returns rows and cursor of the next page, None on the last page.
+        """
+        statement = self._functions.get(command)
+        if getattr(statement, 'operation', None) != 'fetch':
+            raise ValueError(
+                'Only fetch_ statements can be paginated, not {}'.format(
+                    command
+                )
+            )
+        if not limit:
+            raise ValueError('Keyset pagination requires a limit')
+
+        after = None
+        if cursor is not None:
+            after = decode_page_cursor(cursor)
+
+        load = functools.partial(
+            self._fetch_page,
+            statement,
+            key,
+            kwargs,
+            cursor is not None,
+            after,
+            limit,
+        )
+        cache_key = None
+        if cache:
+            cache_key = self._try_cache_key(
+                command,
+                dict(kwargs, _key=key, _cursor=cursor),
+                0,
+                limit,
+            )
+        if cache_key is not None:
+            rows = self._cached(cache_key, cache_ttl, load)
+        else:
+            rows = load()
+
+        next_cursor = None
+        if len(rows) >= limit:
+            next_cursor = encode_page_cursor(rows[-1][key])
+        return rows, next_cursor
+
+    def _fetch_page(
+        self,
+        statement,  # type: typing.Any
+        key,  # type: str
+        params,  # type: typing.Dict[str, typing.Any]
+        has_after,  # type: bool
+        after,  # type: typing.Any
+        limit,  # type: int
+    ):
+        # type: (...) -> typing.List[dict]
+        raise NotImplementedError
+
+    def invalidate(self, command, skip=0, limit=10, **kwargs):
+        # type: (str, int, typing.Optional[int], **typing.Any) -> None
+        """Removes cached result of a command with specified arguments."""
+        cache_key = self._try_cache_key(command, kwargs, skip, limit)
+        if cache_key is None:
+            # Nothing could have been cached
+            return
+        self._memo.pop(cache_key, None)
+        self._cache.delete(cache_key)
+
     def close(self):
         # type: () -> None
         raise NotImplementedError
@@ -67,28 +562,92 @@ class BaseBackend(object):
         # type: () -> bool
         raise NotImplementedError
 
+    def _get_acl_options(self):
+        # type: () -> AclOptions
+        """
+        Returns process wide ACL option index. Once in a while one thread
+        checks whether cached options changed, others keep using the index
+        they already have.
+        """
+        scope = (
+            self._config.get('HOST'),
+            self._config.get('DATABASE'),
+            self._config.get('TABLE_PREFIX'),
+        )
+        entry = _acl_options.get(scope)
+        if entry is not None:
+            acl_options, checked_at = entry
+            if checked_at + ACL_OPTIONS_REFRESH_INTERVAL > time.time()\
+               or not _acl_options_lock.acquire(False):
+                return acl_options
+        else:
+            _acl_options_lock.acquire()
+
+        try:
+            # Some other thread might have already refreshed it
+            entry = _acl_options.get(scope)
+            if entry is not None\
+               and entry[1] + ACL_OPTIONS_REFRESH_INTERVAL > time.time():
+                return entry[0]
+
+            raw_acl_options = self.execute(
+                'fetch_acl_options',
+                cache=True,
+                cache_ttl=ACL_OPTIONS_CACHE_TTL,
+                limit=None,
+            )
+            version = AclOptions.make_version(raw_acl_options)
+            if entry is not None and entry[0].version == version:
+                acl_options = entry[0]
+            else:
+                acl_options = AclOptions(raw_acl_options)
+
+            _acl_options[scope] = (acl_options, time.time())
+            return acl_options
+        finally:
+            _acl_options_lock.release()
+
     def get_user_acl(self, raw_user_permissions):
         # type: (str) -> UserAcl
-        raw_acl_options = self.execute(
-            'fetch_acl_options',
-            cache=True,
-            cache_ttl=ACL_OPTIONS_CACHE_TTL,
-            limit=None,
+        acl_options = self._get_acl_options()
+
+        cache_key = (
+            acl_options.version,
+            hashlib.sha1(_to_bytes(raw_user_permissions)).digest(),
         )
+        user_acl = _user_acls.get(cache_key)  # type: typing.Optional[UserAcl]
+        if user_acl is None:
+            user_acl = UserAcl(acl_options, raw_user_permissions)
+            _user_acls.set(cache_key, user_acl)
+        return user_acl
 
-        return UserAcl(raw_acl_options, raw_user_permissions)
 
+class AclOptions(object):
+    """Immutable index of ACL option names to their bit positions."""
+    __slots__ = ('version', '_planes')
 
-class UserAcl(object):
-    def __init__(self, raw_acl_options, raw_user_permissions):
-        # type: (typing.List[dict], str) -> None
-        self._acl_options = self._parse_acl_options(raw_acl_options)
-        self._acl = self._parse_user_permissions(raw_user_permissions)
-        self._acl_lookup_cache = {}  # type: dict
+    def __init__(self, raw_acl_options):
+        # type: (typing.Optional[typing.List[dict]]) -> None
+        self.version = self.make_version(raw_acl_options)
+        self._planes = self._parse(raw_acl_options)
+
+    @classmethod
+    def make_version(cls, raw_acl_options):
+        # type: (typing.Optional[typing.List[dict]]) -> bytes
+        """Digest of ACL options, bit positions depend on their order."""
+        encoded_options = u'\n'.join(
+            u'{}:{}:{}'.format(
+                opt['auth_option'],
+                opt['is_local'],
+                opt['is_global'],
+            )
+            for opt in raw_acl_options or []
+        )
+        return hashlib.sha1(_to_bytes(encoded_options)).digest()
 
     @classmethod
-    def _parse_acl_options(cls, raw_acl_options):
-        # type: (typing.List[dict]) -> dict
+    def _parse(cls, raw_acl_options):
+        # type: (typing.Optional[typing.List[dict]]) -> dict
         # Load ACL options, so we can decode the user ACL
         acl_options = {
             'local': {},
@@ -111,80 +670,164 @@ class UserAcl(object):
 
         return acl_options
 
-    @classmethod
-    def _parse_user_permissions(cls, raw_user_permissions):
-        # type: (str) -> dict
-        seq_cache = {}  # type: dict
-        acl = {}
-
-        split_user_permissions = raw_user_permissions\
-            .rstrip()\
-            .splitlines()
-        for forum_id, perms in enumerate(split_user_permissions):
-            if not perms:
-                continue
+    def __getitem__(self, plane):
+        # type: (str) -> typing.Dict[str, int]
+        output = self._planes[plane]  # type: typing.Dict[str, int]
+        return output
+
 
-            # Do the conversion magic
-            acl[str(forum_id)] = ''
-            for sub in [perms[j:j + 6] for j in range(0, len(perms), 6)]:
-                if sub in seq_cache:
-                    converted = seq_cache[sub]
-                else:
-                    converted = bin(int(sub, 36))[2:]
-                    converted = seq_cache[sub] = '0'\
-                                                 * (31 - len(converted))\
-                                                 + converted
+class UserAcl(object):
+    def __init__(self, raw_acl_options, raw_user_permissions):
+        # type: (typing.Union[AclOptions, typing.List[dict]], str) -> None
+        if not isinstance(raw_acl_options, AclOptions):
+            raw_acl_options = AclOptions(raw_acl_options)
+        self._acl_options = raw_acl_options
+
+        # Forums are decoded once they are accessed, global ones right away
+        self._lines = raw_user_permissions.rstrip().splitlines()
+        self._acl = {}  # type: typing.Dict[int, array.array]
+        self._get_forum(0)
+        # Resolved privileges, by forum id and option
+        self._acl_lookup_cache = {}\
+            # type: typing.Dict[typing.Tuple[int, str], bool]
 
-                acl[str(forum_id)] += converted
+    @classmethod
+    def _decode_forum(cls, perms):
+        # type: (str) -> array.array
+        # Do the conversion magic, each chunk holds 31 bits
+        return array.array(ACL_TYPECODE, [
+            int(perms[j:j + ACL_CHUNK_SIZE], 36)
+            for j in range(0, len(perms), ACL_CHUNK_SIZE)
+        ])
+
+    def _get_forum(self, forum_id):
+        # type: (int) -> typing.Optional[array.array]
+        """Returns decoded permissions of forum, None if it has none."""
+        chunks = self._acl.get(forum_id)
+        if chunks is None\
+           and 0 <= forum_id < len(self._lines)\
+           and self._lines[forum_id]:
+            chunks = self._acl[forum_id] =\
+                self._decode_forum(self._lines[forum_id])
+        return chunks
 
-        return acl
+    @classmethod
+    def _is_set(cls, chunks, index):
+        # type: (array.array, int) -> bool
+        """Tests bit at index, raises IndexError if out of bounds."""
+        chunk, bit = divmod(index, ACL_CHUNK_BITS)
+        return bool(chunks[chunk] >> (ACL_CHUNK_BITS - 1 - bit) & 1)
 
     def has_privilege(self, privilege, forum_id=0):
         # type: (str, int) -> bool
         # Parse negation
-        str_forum_id = str(forum_id)
-
         negated = privilege.startswith('!')
         if negated:
             option = privilege[1:]
         else:
             option = privilege
 
-        self._acl_lookup_cache.setdefault(str_forum_id, {})[option] = False
+        try:
+            forum_id = int(forum_id)
+        except (TypeError, ValueError):
+            # Not a forum, only global permissions apply
+            forum_id = -1
+
+        cache_key = (forum_id, option)
+        granted = self._acl_lookup_cache.get(cache_key)
+        if granted is None:
+            granted = self._lookup(option, forum_id)
+            # ACL is shared between requests, forums outside permissions
+            # all have the same answer, so only known ones are memoized
+            if 0 <= forum_id < len(self._lines):
+                self._acl_lookup_cache[cache_key] = granted
+
+        output = negated ^ granted  # type: bool
+        return output
+
+    def _lookup(self, option, forum_id):
+        # type: (str, int) -> bool
+        granted = False
 
         # Global permissions
+        global_chunks = self._get_forum(0)
         if option in self._acl_options['global']\
-           and '0' in self._acl:
+           and global_chunks is not None:
             try:
                 acl_option = self._acl_options['global'][option]
-                permission = self._acl['0'][acl_option]
-                self._acl_lookup_cache[str_forum_id][option] =\
-                    bool(int(permission))
+                granted = self._is_set(global_chunks, acl_option)
             except IndexError:
                 pass
 
         # Local permissions
-        if str_forum_id != '0'\
+        if not granted\
+           and forum_id != 0\
            and option in self._acl_options['local']:
-            try:
-                acl_option = self._acl_options['local'][option]
-                permission =\
-                    self._acl.get(str_forum_id, '0' * 31)[acl_option]
-                self._acl_lookup_cache[str_forum_id][option] |=\
-                    bool(int(permission))
-            except IndexError:
-                pass
+            local_chunks = self._get_forum(forum_id)
+            if local_chunks is not None:
+                try:
+                    acl_option = self._acl_options['local'][option]
+                    granted = self._is_set(local_chunks, acl_option)
+                except IndexError:
+                    pass
 
-        output = (
-            negated ^ self._acl_lookup_cache[str_forum_id][option]
-        )  # type: bool
-        return output
+        return granted
 
     def has_privileges(self, *privileges, **kwargs):
         # type: (*str, **int) -> bool
         forum_id = kwargs.get('forum_id', 0)
 
-        output = False
         for option in privileges:
-            output |= self.has_privilege(option, forum_id=forum_id)
-        return output
+            if self.has_privilege(option, forum_id=forum_id):
+                return True
+        return False
+
+    def forums_with_privilege(self, *options):
+        # type: (*str) -> typing.FrozenSet[int]
+        """
+        Returns ids of forums in user permissions, where any of options is
+        granted. Computed in a single pass over all forums.
+        """
+        masks = []  # type: typing.List[typing.Tuple[int, int]]
+        for option in options:
+            if option.startswith('!'):
+                raise ValueError(
+                    'Negated option {} is not supported'.format(option)
+                )
+
+            # Global permissions apply to every forum
+            global_chunks = self._get_forum(0)
+            if option in self._acl_options['global']\
+               and global_chunks is not None:
+                try:
+                    if self._is_set(
+                        global_chunks,
+                        self._acl_options['global'][option],
+                    ):
+                        return frozenset(
+                            forum_id
+                            for forum_id, perms in enumerate(self._lines)
+                            if forum_id != 0 and perms
+                        )
+                except IndexError:
+                    pass
+
+            if option in self._acl_options['local']:
+                chunk, bit = divmod(
+                    self._acl_options['local'][option],
+                    ACL_CHUNK_BITS,
+                )
+                masks.append((chunk, 1 << (ACL_CHUNK_BITS - 1 - bit)))
+
+        if not masks:
+            return frozenset()
+
+        output = set()
+        for forum_id in range(1, len(self._lines)):
+            chunks = self._get_forum(forum_id)
+            if chunks is not None and any(
+                chunk < len(chunks) and chunks[chunk] & mask
+                for chunk, mask in masks
+            ):
+                output.add(forum_id)
+        return frozenset(output)
@@ -1,6 +1,12 @@
 from __future__ import absolute_import
 
-import json
+import functools
+import hashlib
+import itertools
+import os
+import re
+import threading
+import time
 import typing
 
 try:
@@ -10,21 +16,298 @@ except ImportError:
     compat.register()
 import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 
 from . import base
 
+# Process wide connection pools, keyed by process id and DSN
+_pools = {}  # type: typing.Dict[typing.Tuple[int, str], ConnectionPool]
+_pools_lock = threading.Lock()
 
-class Psycopg2Backend(base.BaseBackend):
-    def _setup_connection(self):
+# Names of server-side cursors
+_cursor_ids = itertools.count()
+
+_NAMED_PARAMETER = re.compile(r'%(?:\((\w+)\)s|%)')
+_IDENTIFIER = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+# User columns session integration can not do without
+REQUIRED_SESSION_COLUMNS = ('user_id', 'username')
+
+
+class Connection(psycopg2.extensions.connection):
+    """Connection, which remembers its server-side prepared statements."""
+    def __init__(self, *args, **kwargs):
+        # type: (*typing.Any, **typing.Any) -> None
+        super(Connection, self).__init__(*args, **kwargs)
+        self.prepared_statements = set()  # type: typing.Set[str]
+
+
+class PreparedQuery(object):
+    """Query converted to positional parameters for PREPARE/EXECUTE."""
+    def __init__(self, query, paginate):
+        # type: (str, bool) -> None
+        self.parameters = []  # type: typing.List[str]
+
+        def replace(match):
+            # type: (typing.Match) -> str
+            name = match.group(1)
+            if name is None:
+                # Escaped percent sign
+                return '%'
+            if name not in self.parameters:
+                self.parameters.append(name)
+            return '${:d}'.format(self.parameters.index(name) + 1)
+
+        self.query = _NAMED_PARAMETER.sub(replace, query)
+        if paginate:
+            self.query += ' OFFSET ${:d} LIMIT ${:d}'.format(
+                len(self.parameters) + 1,
+                len(self.parameters) + 2,
+            )
+        self.paginate = paginate
+
+        encoded_query = self.query
+        if not isinstance(encoded_query, bytes):
+            encoded_query = encoded_query.encode('utf-8')
+        self.name = 'phpbb3_' + hashlib.sha1(encoded_query).hexdigest()[:16]
+        self.prepare = 'PREPARE {name} AS {query}'.format(
+            name=self.name,
+            query=self.query,
+        )
+
+        placeholders = ', '.join(
+            ['%s'] * (len(self.parameters) + (2 if paginate else 0))
+        )
+        self.execute = 'EXECUTE ' + self.name
+        if placeholders:
+            self.execute += ' (' + placeholders + ')'
+
+    def values(self, params, skip=0, limit=None):
+        # type: (dict, int, typing.Optional[int]) -> list
+        output = [params[name] for name in self.parameters]
+        if self.paginate:
+            output += [skip, limit]
+        return output
+
+
+class Psycopg2Statement(base.Statement):
+    """Statement with pagination and prepared variants compiled upfront."""
+    __slots__ = ('paginated_query', 'prepared')
+
+    def __init__(self, name, query, table_prefix):
+        # type: (str, str, str) -> None
+        super(Psycopg2Statement, self).__init__(name, query, table_prefix)
+
+        paginate = self.operation == 'fetch'
+        self.paginated_query = None  # type: typing.Optional[str]
+        if paginate:
+            self.paginated_query =\
+                self.query + ' OFFSET %(_skip)s LIMIT %(_limit)s'
+        self.prepared = PreparedQuery(self.query, paginate)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of connections.
+
+    Idle connections are kept up to max_size, checked on checkout and reset
+    when they are returned.
+    """
+    def __init__(
+        self,
+        dsn,  # type: str
+        min_size=1,  # type: int
+        max_size=10,  # type: int
+        timeout=None,  # type: typing.Optional[float]
+        ping=False,  # type: bool
+    ):
+        # type: (...) -> None
+        self._dsn = dsn
+        self._max_size = max_size
+        self._timeout = timeout
+        self._ping = ping
+
+        self._condition = threading.Condition()
+        self._idle = []  # type: typing.List[psycopg2.extensions.connection]
+        self._size = 0
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        # type: () -> psycopg2.extensions.connection
+        return psycopg2.connect(
+            self._dsn,
+            connection_factory=Connection
+        )
+
+    def _is_healthy(self, connection):
+        # type: (psycopg2.extensions.connection) -> bool
+        if connection.closed:
+            return False
+
+        status = connection.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        if self._ping:
+            try:
+                cursor = connection.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+    def _release_slot(self):
         # type: () -> None
-        self._connection = psycopg2.connect(
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _discard(self, connection):
+        # type: (psycopg2.extensions.connection) -> None
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        self._release_slot()
+
+    def getconn(self):
+        # type: () -> psycopg2.extensions.connection
+        """Checks out a healthy connection, waits if pool is exhausted."""
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+
+        while True:
+            connection = None
+            with self._condition:
+                while not self._idle and self._size >= self._max_size:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise psycopg2.pool.PoolError(
+                                'connection pool exhausted'
+                            )
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    connection = self._idle.pop()
+                else:
+                    # Reserve a slot, connect outside of the lock
+                    self._size += 1
+
+            if connection is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            if self._is_healthy(connection):
+                return connection
+            self._discard(connection)
+
+    def putconn(self, connection):
+        # type: (psycopg2.extensions.connection) -> None
+        """Resets the connection and returns it to the pool."""
+        if connection.closed:
+            self._release_slot()
+            return
+
+        status = connection.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            self._discard(connection)
+            return
+        elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                self._discard(connection)
+                return
+
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def closeall(self):
+        # type: () -> None
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
+
+
+def _use_wait_callback(green):
+    # type: (typing.Any) -> None
+    """
+    Makes psycopg2 wait for results through a callback, so green threads
+    (gevent, eventlet) can run while a query is executed. The callback is
+    process wide.
+    """
+    if callable(green):
+        callback = green
+    else:
+        callback = psycopg2.extras.wait_select
+
+    if psycopg2.extensions.get_wait_callback() is not callback:
+        psycopg2.extensions.set_wait_callback(callback)
+
+
+def _get_pool(dsn, pool_config):
+    # type: (str, dict) -> ConnectionPool
+    """Returns process wide pool for specified DSN."""
+    key = (os.getpid(), dsn)
+
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    dsn,
+                    min_size=pool_config.get('MIN_SIZE', 1),
+                    max_size=pool_config.get('MAX_SIZE', 10),
+                    timeout=pool_config.get('TIMEOUT', 30),
+                    ping=pool_config.get('PING', False),
+                )
+    return pool
+
+
+class Psycopg2Backend(base.BaseBackend):
+    statement_class = Psycopg2Statement
+    _pool = None  # type: typing.Optional[ConnectionPool]
+
+    @property
+    def _dsn(self):
+        # type: () -> str
+        return (
             'dbname={DATABASE}'
             ' host={HOST}'
             ' user={USER}'
-            ' password={PASSWORD}'.format(**self._config),
-            connection_factory=psycopg2.extras.DictConnection
+            ' password={PASSWORD}'.format(**self._config)
         )
 
+    def _setup_connection(self):
+        # type: () -> None
+        if self._config.get('GREEN'):
+            _use_wait_callback(self._config['GREEN'])
+
+        pool_config = self._config.get('POOL')
+        if pool_config:
+            self._pool = _get_pool(self._dsn, pool_config)
+            self._connection = self._pool.getconn()
+        else:
+            self._connection = psycopg2.connect(
+                self._dsn,
+                connection_factory=Connection
+            )
+
     @property
     def _db(self):
         # type: () -> psycopg2.extensions.connection
@@ -33,12 +316,13 @@ class Psycopg2Backend(base.BaseBackend):
 
         return self._connection
 
-    def _prepare_statements(self):
-        # type: () -> None
+    @classmethod
+    def _prepare_statements(cls, config):
+        # type: (typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]
         """
         Initializes prepared SQL statements, depending on version of PHPBB3
         """
-        self._functions.update(dict(
+        functions = dict(
             get_autologin=(
                 "SELECT u.* "
                 "FROM {TABLE_PREFIX}users u,"
@@ -49,7 +333,7 @@ class Psycopg2Backend(base.BaseBackend):
                 "AND k.key_id = %(key)s"
             ),
             get_session=(
-                "SELECT * "
+                "SELECT " + cls._session_columns(config) + " "
                 "FROM {TABLE_PREFIX}sessions s, {TABLE_PREFIX}users u "
                 "WHERE s.session_id = %(session_id)s "
                 "AND s.session_user_id=u.user_id"
@@ -58,6 +342,10 @@ class Psycopg2Backend(base.BaseBackend):
                 "SELECT * "
                 "FROM {TABLE_PREFIX}users "
                 "WHERE user_id = %(user_id)s"),
+            batch_get_user=(
+                "SELECT * "
+                "FROM {TABLE_PREFIX}users "
+                "WHERE user_id = ANY(%(user_id)s)"),
             get_user_profile=(
                 "SELECT * "
                 "FROM {TABLE_PREFIX}profile_fields_data "
@@ -88,6 +376,16 @@ class Psycopg2Backend(base.BaseBackend):
                 " ORDER BY"
                 "   auth_option_id"
             ),
+            fetch_bots=(
+                "SELECT"
+                "   bot_agent"
+                " FROM"
+                "   {TABLE_PREFIX}bots"
+                " WHERE"
+                "   bot_active = 1"
+                " ORDER BY"
+                "   bot_id"
+            ),
             get_unread_notifications_count=(
                 "SELECT"
                 "   COUNT(n.*) as num"
@@ -100,21 +398,42 @@ class Psycopg2Backend(base.BaseBackend):
                 "   AND nt.notification_type_enabled=1 "
                 "   AND n.notification_read=0"
             ),
-        ))
+        )  # type: typing.Dict[str, typing.Any]
 
-        self._prepare_custom_fields_statements()
+        functions.update(cls._prepare_custom_fields_statements(config))
 
         # TODO Add/Move to version specific queries
+        return functions
 
-    def _prepare_custom_fields_statements(self):
-        # type: () -> None
+    @classmethod
+    def _session_columns(cls, config):
+        # type: (typing.Dict[str, typing.Any]) -> str
+        """Returns select list of get_session, all columns by default."""
+        columns = config.get('SESSION_COLUMNS')
+        if not columns:
+            return '*'
+
+        selected = list(REQUIRED_SESSION_COLUMNS)
+        for column in columns:
+            if not _IDENTIFIER.match(column):
+                raise ValueError('Invalid session column {}'.format(column))
+            if column not in selected:
+                selected.append(column)
+
+        return ', '.join(['s.*'] + ['u.' + column for column in selected])
+
+    @classmethod
+    def _prepare_custom_fields_statements(cls, config):
+        # type: (typing.Dict[str, typing.Any]) -> typing.Dict[str, str]
         """
         Prepares statements for custom fields
         """
+        functions = {}
+
         # Setters for custom fields
-        custom_fields = self._config.get('CUSTOM_USER_FIELDS', [])
+        custom_fields = config.get('CUSTOM_USER_FIELDS', [])
         for custom_field in custom_fields:
-            self._functions["set_{0}".format(custom_field)] = (
+            functions["set_{0}".format(custom_field)] = (
                 "UPDATE"
                 "   {TABLE_PREFIX}profile_fields_data"
                 " SET"
@@ -122,14 +441,15 @@ class Psycopg2Backend(base.BaseBackend):
                 " WHERE"
                 "   user_id = %(user_id)s"
             ).format(
-                TABLE_PREFIX=self._config['TABLE_PREFIX'],
+                TABLE_PREFIX=config['TABLE_PREFIX'],
                 field=custom_field,
             )
 
+        return functions
+
     def _sql_query(
         self,
-        operation,  # type: str
-        query,  # type: str
+        statement,  # type: Psycopg2Statement
         cache_key_prefix=None,  # type: typing.Optional[str]
         cache_ttl=None,  # type: typing.Optional[int]
         skip=0,  # type: int
@@ -138,46 +458,46 @@ class Psycopg2Backend(base.BaseBackend):
     ):
         # type: (...) -> typing.Any
         """Executes a query with values in kwargs."""
-        if operation not in self.KNOWN_OPERATIONS:
-            raise ValueError("Unknown operation")
+        operation = statement.operation
+
+        load = functools.partial(
+            self._execute_statement,
+            statement,
+            kwargs,
+            skip,
+            limit,
+        )
 
         cache_key = None
         if cache_key_prefix and operation != 'set':
-            cache_key = '{name}:{arguments}'.format(
-                name=cache_key_prefix,
-                arguments=':'.join(key + str(value)
-                                   for key, value in kwargs.items())
+            cache_key = self._try_cache_key(
+                cache_key_prefix,
+                kwargs,
+                skip,
+                limit,
             )
-            raw_data = self._cache.get(cache_key)
-            if raw_data and isinstance(raw_data, (str, unicode)):
-                try:
-                    return json.loads(raw_data)
-                except ValueError:
-                    # Woops :S
-                    pass
-
-        if operation == 'fetch':
-            query = self._paginate_query(query, skip, limit)
+        if cache_key is not None:
+            return self._cached(cache_key, cache_ttl, load)
+        return load()
 
-        output = self._execute_operation(operation, query, kwargs)
-
-        if cache_key:
-            try:
-                self._cache.set(cache_key,
-                                json.dumps(output),
-                                cache_ttl)
-            except ValueError:
-                # Woops :S
-                pass
+    def _execute_statement(
+        self,
+        statement,  # type: Psycopg2Statement
+        params,  # type: typing.Dict[str, typing.Any]
+        skip=0,  # type: int
+        limit=10,  # type: typing.Optional[int]
+    ):
+        # type: (...) -> typing.Any
+        if self._config.get('PREPARE'):
+            return self._execute_prepared(statement, params, skip, limit)
 
-        return output
+        query = statement.query
+        if statement.paginated_query is not None:
+            # Only fetch_ statements are paginated
+            query = statement.paginated_query
+            params = dict(params, _skip=skip, _limit=limit or None)
 
-    def _paginate_query(self, query, skip, limit):
-        # type: (str, int, typing.Optional[int]) -> str
-        output = query + ' OFFSET {:d}'.format(skip)
-        if limit:
-            output += ' LIMIT {:d}'.format(limit)
-        return output
+        return self._execute_operation(statement.operation, query, params)
 
     def _execute_operation(
         self,
@@ -187,20 +507,52 @@ class Psycopg2Backend(base.BaseBackend):
     ):
         # type: (...) -> typing.Any
         cursor = self._db.cursor()
+        cursor.execute(query, params)
+
+        return self._fetch_output(operation, cursor)
+
+    def _execute_prepared(
+        self,
+        statement,  # type: Psycopg2Statement
+        params,  # type: typing.Dict[str, typing.Union[str, int]]
+        skip=0,  # type: int
+        limit=10,  # type: typing.Optional[int]
+    ):
+        # type: (...) -> typing.Any
+        """Executes statement as a server-side prepared statement."""
+        prepared = statement.prepared
+
+        connection = self._db
+        cursor = connection.cursor()
+
+        if prepared.name not in connection.prepared_statements:
+            cursor.execute(prepared.prepare)
+            connection.prepared_statements.add(prepared.name)
 
         cursor.execute(
-            query.format(TABLE_PREFIX=self._config['TABLE_PREFIX']),
-            params
+            prepared.execute,
+            prepared.values(params, skip, limit or None),
         )
 
+        return self._fetch_output(statement.operation, cursor)
+
+    @classmethod
+    def _column_names(cls, cursor):
+        # type: (psycopg2.extensions.cursor) -> typing.List[str]
+        return [column[0] for column in cursor.description]
+
+    def _fetch_output(self, operation, cursor):
+        # type: (str, psycopg2.extensions.cursor) -> typing.Any
+        # Rows are plain tuples, each is turned into a dict only once
         if operation == 'get':
             output = cursor.fetchone()
             if output is not None:
-                output = dict(output)
+                output = dict(zip(self._column_names(cursor), output))
         elif operation == 'has':
             output = bool(cursor.fetchone())
-        elif operation == 'fetch':
-            output = [dict(i) for i in cursor]
+        elif operation in ('fetch', 'batch'):
+            names = self._column_names(cursor)
+            output = [dict(zip(names, row)) for row in cursor]
         elif operation == 'set':
             # It is an update
             output = cursor.statusmessage
@@ -230,27 +582,123 @@ class Psycopg2Backend(base.BaseBackend):
                 command
             ))
 
-        operation = command.split('_')[0]
-
-        func_or_query = self._functions[command]
-        if callable(func_or_query):
-            return func_or_query(**kwargs)
+        func_or_statement = self._functions[command]
+        if callable(func_or_statement):
+            return func_or_statement(**kwargs)
         else:
-            return self._sql_query(
-                operation,
-                func_or_query,
-                cache_key_prefix=cache_key_prefix,
-                cache_ttl=cache_ttl,
-                skip=skip,
-                limit=limit,
-                **kwargs
+            return self._memoized(
+                command,
+                kwargs,
+                skip,
+                limit,
+                functools.partial(
+                    self._sql_query,
+                    func_or_statement,
+                    cache_key_prefix=cache_key_prefix,
+                    cache_ttl=cache_ttl,
+                    skip=skip,
+                    limit=limit,
+                    **kwargs
+                ),
             )
 
+    def _fetch_page(
+        self,
+        statement,  # type: Psycopg2Statement
+        key,  # type: str
+        params,  # type: typing.Dict[str, typing.Any]
+        has_after,  # type: bool
+        after,  # type: typing.Any
+        limit,  # type: int
+    ):
+        # type: (...) -> typing.List[dict]
+        if not _IDENTIFIER.match(key):
+            raise ValueError('Invalid pagination key {}'.format(key))
+
+        # Statement is wrapped, so rows are sought by key, not skipped
+        query = 'SELECT * FROM (' + statement.query + ') AS page'
+        if has_after:
+            query += ' WHERE page.' + key + ' > %(_after)s'
+        query += ' ORDER BY page.' + key + ' LIMIT %(_limit)s'
+
+        output = self._execute_operation(
+            'fetch',
+            query,
+            dict(params, _after=after, _limit=limit),
+        )  # type: typing.List[dict]
+        return output
+
+    def stream(
+        self,
+        command,  # type: str
+        skip=0,  # type: int
+        limit=None,  # type: typing.Optional[int]
+        **kwargs  # type: typing.Union[int, str]
+    ):
+        # type: (...) -> typing.Iterator[dict]
+        statement = self._functions.get(command)
+        if getattr(statement, 'operation', None) != 'fetch':
+            raise ValueError(
+                'Only fetch_ statements can be streamed, not {}'.format(
+                    command
+                )
+            )
+
+        # Cursor is opened right away, so a stream consumed after backend
+        # is closed fails instead of opening a new connection
+        connection = self._db
+        cursor = connection.cursor(
+            'phpbb3_stream_{:d}'.format(next(_cursor_ids))
+        )
+        cursor.itersize = self._config.get('ITERSIZE', 2000)
+        try:
+            cursor.execute(
+                statement.paginated_query,
+                dict(kwargs, _skip=skip, _limit=limit or None),
+            )
+        except Exception:
+            cursor.close()
+            raise
+        return self._stream(connection, cursor)
+
+    def _stream(
+        self,
+        connection,  # type: psycopg2.extensions.connection
+        cursor,  # type: psycopg2.extensions.cursor
+    ):
+        # type: (...) -> typing.Iterator[dict]
+        try:
+            if self._connection is not connection:
+                # Connection was closed or handed to another request
+                raise psycopg2.InterfaceError(
+                    'Backend was closed, consume stream within app context'
+                )
+
+            # Named cursors describe columns once rows are fetched
+            names = None
+            for row in cursor:
+                if names is None:
+                    names = self._column_names(cursor)
+                yield dict(zip(names, row))
+        finally:
+            if self._connection is connection:
+                cursor.close()
+
     def close(self):
         # type: () -> None
-        self._db.close()
+        self._memo.clear()
+        if self._connection is None:
+            # Never connected, nothing to do
+            return
+
+        if self._pool is not None:
+            # Hand the connection back to the pool
+            self._pool.putconn(self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
 
     @property
     def is_closed(self):
         # type: () -> bool
-        return bool(self._db.closed)
+        return self._connection is not None and bool(self._connection.closed)
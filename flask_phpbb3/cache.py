@@ -0,0 +1,299 @@
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import datetime
+import decimal
+import hashlib
+import json
+import numbers
+import re
+import threading
+import time
+import typing
+import uuid
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle  # type: ignore
+
+# Memcached allows 250 bytes, leave some room for key prefix
+MAX_KEY_LENGTH = 200
+_SAFE_KEY = re.compile(r'^[\x21-\x7e]+$')
+# Highest protocol readable by both Python 2 and 3 workers
+PICKLE_PROTOCOL = 2
+# Values of these types are encoded in cache keys by their repr
+_REPR_TYPES = (
+    datetime.date,
+    datetime.time,
+    datetime.timedelta,
+    decimal.Decimal,
+    uuid.UUID,
+)
+
+
+def _json_dumps(value):
+    # type: (typing.Any) -> bytes
+    output = json.dumps(value, separators=(',', ':'))
+    if not isinstance(output, bytes):
+        output = output.encode('utf-8')
+    return output
+
+
+def _json_loads(data):
+    # type: (bytes) -> typing.Any
+    return json.loads(data.decode('utf-8'))
+
+
+def _pickle_dumps(value):
+    # type: (typing.Any) -> bytes
+    return pickle.dumps(value, PICKLE_PROTOCOL)
+
+
+def _msgpack_dumps(value):
+    # type: (typing.Any) -> bytes
+    import msgpack
+    output = msgpack.packb(value, use_bin_type=True)  # type: bytes
+    return output
+
+
+def _msgpack_loads(data):
+    # type: (bytes) -> typing.Any
+    import msgpack
+    return msgpack.unpackb(data, raw=False)
+
+
+def _lz4_compress(data):
+    # type: (bytes) -> bytes
+    import lz4.frame
+    output = lz4.frame.compress(data)  # type: bytes
+    return output
+
+
+def _lz4_decompress(data):
+    # type: (bytes) -> bytes
+    import lz4.frame
+    output = lz4.frame.decompress(data)  # type: bytes
+    return output
+
+
+def _zlib_compress(data):
+    # type: (bytes) -> bytes
+    return zlib.compress(data, 1)
+
+
+SERIALIZERS = {
+    'json': (_json_dumps, _json_loads),
+    'pickle': (_pickle_dumps, pickle.loads),
+    'msgpack': (_msgpack_dumps, _msgpack_loads),
+}
+_Codec = typing.Callable[[bytes], bytes]
+# Payload marker, compress and decompress functions
+COMPRESSIONS = {
+    'zlib': (b'z', _zlib_compress, zlib.decompress),
+    'lz4': (b'l', _lz4_compress, _lz4_decompress),
+}  # type: typing.Dict[str, typing.Tuple[bytes, _Codec, _Codec]]
+_UNCOMPRESSED = b'r'
+
+
+class Serializer(object):
+    """Serializes cached values, payloads above threshold are compressed."""
+    def __init__(
+        self,
+        name='pickle',  # type: str
+        compression=None,  # type: typing.Optional[str]
+        compress_threshold=1024,  # type: int
+    ):
+        # type: (...) -> None
+        if name not in SERIALIZERS:
+            raise ValueError('Unsupported serializer {}'.format(name))
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError('Unsupported compression {}'.format(compression))
+
+        self._dumps, self._loads = SERIALIZERS[name]
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+
+    def dumps(self, value):
+        # type: (typing.Any) -> bytes
+        data = self._dumps(value)
+        if self._compression and len(data) >= self._compress_threshold:
+            marker, compress, _ = COMPRESSIONS[self._compression]
+            return marker + compress(data)
+        return _UNCOMPRESSED + data
+
+    def loads(self, data):
+        # type: (bytes) -> typing.Any
+        marker, data = data[:1], data[1:]
+        if marker != _UNCOMPRESSED:
+            # Payload could have been compressed with other setting
+            for compression_marker, _, decompress in COMPRESSIONS.values():
+                if marker == compression_marker:
+                    data = decompress(data)
+                    break
+            else:
+                raise ValueError('Unknown payload')
+        return self._loads(data)
+
+
+def _encode_value(value):
+    # type: (typing.Any) -> typing.Text
+    """Encodes a value with its type, strings are length prefixed."""
+    if value is None:
+        return u'n'
+    if isinstance(value, bool):
+        return u'b1' if value else u'b0'
+    if isinstance(value, numbers.Integral):
+        return u'i{:d}'.format(value)
+    if isinstance(value, float):
+        return u'f' + repr(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        if isinstance(value, (set, frozenset)):
+            value = sorted(value)
+        return u'l{:d}:'.format(len(value))\
+            + u','.join(_encode_value(i) for i in value)
+    if isinstance(value, dict):
+        items = sorted(
+            _encode_value(k) + u'=' + _encode_value(v)
+            for k, v in value.items()
+        )
+        return u'd{:d}:'.format(len(items)) + u','.join(items)
+    if isinstance(value, _REPR_TYPES):
+        value = u'{}:{!r}'.format(type(value).__name__, value)
+        return u'r{:d}:{}'.format(len(value), value)
+
+    tag = u's'
+    if isinstance(value, bytes):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            tag = u'y'
+            value = value.decode('latin-1')
+    elif not isinstance(value, type(u'')):
+        raise TypeError('Unsupported type {} in cache key'.format(
+            type(value).__name__
+        ))
+    return u'{}{:d}:{}'.format(tag, len(value), value)
+
+
+def make_key(name, arguments, version=None):
+    # type: (str, typing.Dict[str, typing.Any], typing.Optional[str]) -> str
+    """
+    Builds a cache key, which does not depend on order of arguments. Too
+    long keys or ones memcached would not accept are hashed.
+    """
+    prefix = name
+    if version:
+        prefix += ':' + version
+
+    encoded_arguments = u','.join(
+        u'{}={}'.format(key, _encode_value(value))
+        for key, value in sorted(arguments.items())
+    )
+    key = u'{}:{}'.format(prefix, encoded_arguments)
+
+    if len(key) > MAX_KEY_LENGTH or not _SAFE_KEY.match(key):
+        digest = hashlib.sha1(encoded_arguments.encode('utf-8')).hexdigest()
+        key = u'{}:h{}'.format(prefix, digest)
+        if len(key) > MAX_KEY_LENGTH or not _SAFE_KEY.match(key):
+            key = u'h' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return str(key)
+
+
+class LocalCache(object):
+    """Bounded, thread-safe, in-process LRU cache with per entry TTL."""
+    def __init__(self, max_size=1024, default_ttl=None):
+        # type: (int, typing.Optional[float]) -> None
+        self._max_size = max_size
+        self._default_ttl = default_ttl
+        self._entries = collections.OrderedDict()\
+            # type: typing.MutableMapping[typing.Any, typing.Tuple]
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        # type: (typing.Any, typing.Any) -> typing.Any
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                return default
+
+            # Mark as recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        # type: (typing.Any, typing.Any, typing.Optional[float]) -> None
+        if ttl is None:
+            ttl = self._default_ttl
+
+        expires = None
+        if ttl:
+            expires = time.time() + ttl
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+
+            # Evict least recently used entries
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)  # type: ignore
+
+    def delete(self, key):
+        # type: (typing.Any) -> None
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        # type: (typing.Any) -> bool
+        marker = object()
+        return self.get(key, marker) is not marker
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._entries)
+
+
+class KeyLocks(object):
+    """Per key locks, a lock is dropped once nobody holds or waits for it."""
+    def __init__(self):
+        # type: () -> None
+        self._locks = {}  # type: typing.Dict[typing.Any, list]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        # type: (typing.Any, bool) -> typing.Iterator[bool]
+        """Holds lock of key, yields whether it was acquired."""
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        try:
+            acquired = entry[0].acquire(blocking)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    entry[0].release()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._locks)
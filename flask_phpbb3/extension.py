@@ -44,12 +44,19 @@ class PhpBB3(object):
         else:
             cache_driver = cache
 
+        # Build statements once, they are shared by all backends
+        backend_class = self._get_backend_class(app.config['PHPBB3']['DRIVER'])
+        statements = backend_class.create_registry(
+            app.config['PHPBB3_DATABASE']
+        )
+
         # Setup teardown
         app.teardown_appcontext(self.teardown)
 
         # Add ourselves to the app, so session interface can function
         app.phpbb3 = self
         app.phpbb3_cache = cache_driver
+        app.phpbb3_statements = statements
 
         # Use our session interface
         # TODO Is it wise to do it here? Should user do it himself?
@@ -70,9 +77,38 @@ class PhpBB3(object):
         app.config['PHPBB3_DATABASE'].setdefault('TABLE_PREFIX', 'phpbb_')
         app.config['PHPBB3_DATABASE'].setdefault('CUSTOM_USER_FIELDS', [])
         app.config['PHPBB3_DATABASE'].setdefault('CUSTOM_STATEMENTS', {})
+        app.config['PHPBB3_DATABASE'].setdefault('POOL', None)
+        app.config['PHPBB3_DATABASE'].setdefault('PREPARE', False)
+        app.config['PHPBB3_DATABASE'].setdefault('GREEN', False)
+        app.config['PHPBB3_DATABASE'].setdefault('ITERSIZE', 2000)
+        app.config['PHPBB3_DATABASE'].setdefault('MEMOIZE', True)
+        app.config['PHPBB3_DATABASE'].setdefault('SESSION_COLUMNS', None)
+        app.config['PHPBB3_DATABASE'].setdefault('CACHE_STALE_TTL', 0)
+        app.config['PHPBB3_DATABASE'].setdefault('CACHE_LOCK_TTL', 10)
+        app.config['PHPBB3_DATABASE'].setdefault('CACHE_SERIALIZER', 'pickle')
+        app.config['PHPBB3_DATABASE'].setdefault('CACHE_COMPRESSION', None)
+        app.config['PHPBB3_DATABASE'].setdefault(
+            'CACHE_COMPRESS_THRESHOLD',
+            1024
+        )
         app.config.setdefault('PHPBB3_SESSION_BACKEND', {})
         app.config['PHPBB3_SESSION_BACKEND'].setdefault('TYPE', 'simple')
+        app.config['PHPBB3_SESSION_BACKEND'].setdefault('SESSION_LENGTH', 3600)
+        app.config['PHPBB3_SESSION_BACKEND'].setdefault('LAZY', False)
+        app.config['PHPBB3_SESSION_BACKEND'].setdefault(
+            'SESSION_CACHE_TTL',
+            0
+        )
+        app.config['PHPBB3_SESSION_BACKEND'].setdefault(
+            'LOCAL_SESSION_CACHE_TTL',
+            0
+        )
+        app.config['PHPBB3_SESSION_BACKEND'].setdefault(
+            'UNKNOWN_SESSION_CACHE_TTL',
+            0
+        )
         app.config.setdefault('PHPBB3_BOTLIST', [])
+        app.config.setdefault('PHPBB3_BOTLIST_DATABASE', False)
 
         # Conditional defaults
         if app.config['PHPBB3_SESSION_BACKEND']['TYPE'] == 'memcached':
@@ -85,22 +121,27 @@ class PhpBB3(object):
                 ['127.0.0.1:11211']
             )
 
+    @classmethod
+    def _get_backend_class(cls, backend_type):
+        # type: (str) -> typing.Type[flask_phpbb3.backends.base.BaseBackend]
+        if backend_type == 'psycopg2':
+            import flask_phpbb3.backends.psycopg2
+            return flask_phpbb3.backends.psycopg2.Psycopg2Backend
+        else:
+            raise ValueError('Unsupported driver {}'.format(backend_type))
+
     @classmethod
     def _create_backend(
         cls,
         backend_type,  # type: str
         config,  # type: dict
-        cache  # type: werkzeug.contrib.cache.BaseCache
+        cache,  # type: werkzeug.contrib.cache.BaseCache
+        statements=None,
+        # type: typing.Optional[flask_phpbb3.backends.base.StatementRegistry]
     ):
         # type: (...) -> flask_phpbb3.backends.base.BaseBackend
-        if backend_type == 'psycopg2':
-            import flask_phpbb3.backends.psycopg2
-            return flask_phpbb3.backends.psycopg2.Psycopg2Backend(
-                cache,
-                config,
-            )
-        else:
-            raise ValueError('Unsupported driver {}'.format(backend_type))
+        backend_class = cls._get_backend_class(backend_type)
+        return backend_class(cache, config, statements)
 
     @property
     def _backend(self):
@@ -112,10 +153,14 @@ class PhpBB3(object):
         if ctx is not None:
             if not hasattr(ctx, 'phpbb3_backend')\
                or ctx.phpbb3_backend.is_closed:
+                if hasattr(ctx, 'phpbb3_backend'):
+                    # Hands broken connection back, so its pool slot is freed
+                    ctx.phpbb3_backend.close()
                 backend = PhpBB3._create_backend(
                     current_app.config['PHPBB3']['DRIVER'],
                     current_app.config['PHPBB3_DATABASE'],
                     current_app.phpbb3_cache,
+                    current_app.phpbb3_statements,
                 )
                 ctx.phpbb3_backend = backend
             else:
@@ -153,6 +198,18 @@ class PhpBB3(object):
         )  # type: typing.Optional[dict]
         return output
 
+    def get_users(self, user_ids, cache=False, cache_ttl=None):
+        # type: (typing.Iterable[int], bool, typing.Optional[int]) -> dict
+        """Fetches multiple users with one query, returns them by user id."""
+        output = self._backend.execute_batch(
+            'get_user',
+            'user_id',
+            user_ids,
+            cache=cache,
+            cache_ttl=cache_ttl,
+        )  # type: dict
+        return output
+
     def get_user_profile(self, user_id, cache=False, cache_ttl=None):
         # type: (int, bool, typing.Optional[int]) -> typing.Optional[dict]
         output = self._backend.execute(
@@ -249,6 +306,51 @@ class PhpBB3(object):
         )  # type: typing.Any
         return output
 
+    def fetch_page(
+        self,
+        command,  # type: str
+        key,  # type: str
+        cursor=None,  # type: typing.Optional[str]
+        limit=10,  # type: int
+        cache=False,  # type: bool
+        cache_ttl=None,  # type: typing.Optional[int]
+        **kwargs  # type: typing.Any
+    ):
+        # type: (...) -> typing.Tuple[typing.List[dict], typing.Optional[str]]
+        """Returns page of fetch_ command rows and cursor of the next one."""
+        output = self._backend.execute_page(
+            command,
+            key,
+            cursor=cursor,
+            limit=limit,
+            cache=cache,
+            cache_ttl=cache_ttl,
+            **kwargs
+        )  # type: typing.Tuple[typing.List[dict], typing.Optional[str]]
+        return output
+
+    def stream_custom(
+        self,
+        command,  # type: str
+        skip=0,  # type: int
+        limit=None,  # type: typing.Optional[int]
+        **kwargs  # type: typing.Any
+    ):
+        # type: (...) -> typing.Iterator[dict]
+        """Iterates over rows of fetch_ command, use it within app context."""
+        output = self._backend.stream(
+            command,
+            skip=skip,
+            limit=limit,
+            **kwargs
+        )  # type: typing.Iterator[dict]
+        return output
+
+    def invalidate(self, command, **kwargs):
+        # type: (str, **typing.Any) -> None
+        """Removes cached result of a command with specified arguments."""
+        self._backend.invalidate(command, **kwargs)
+
     def teardown(self, exception):
         # type: (typing.Any) -> None
         ctx = flask._app_ctx_stack.top
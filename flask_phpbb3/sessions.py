@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
+import functools
 import json
+import re
+import time
 import typing
 
 import flask
@@ -9,10 +12,70 @@ import flask.wrappers
 
 import flask_phpbb3
 import flask_phpbb3.backends.base
+import flask_phpbb3.cache
 
 import werkzeug.contrib.cache
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 ANONYMOUS_CACHE_TTL = 3600 * 24
+# Anonymous user is also kept in worker's memory
+LOCAL_ANONYMOUS_CACHE_TTL = 300
+LOCAL_SESSION_CACHE_SIZE = 1000
+UNKNOWN_SESSION_CACHE_SIZE = 10000
+BOT_VERDICT_CACHE_SIZE = 1000
+BOTLIST_CACHE_TTL = 3600 * 1
+# How often bots table is re-read by a worker
+BOTLIST_REFRESH_INTERVAL = 300
+
+
+class BotMatcher(object):
+    """
+    Matches User-Agent against bot list compiled into regular expressions,
+    verdicts of recent User-Agents are cached.
+    """
+    def __init__(self, prefixes, agents=()):
+        # type: (typing.Iterable[str], typing.Iterable[str]) -> None
+        self.prefixes = list(prefixes)
+        self.agents = list(agents)
+
+        # Configured bots are User-Agent prefixes
+        self._prefix_pattern = None  # type: typing.Optional[typing.Pattern]
+        if self.prefixes:
+            self._prefix_pattern = re.compile(
+                u'|'.join(re.escape(i) for i in self.prefixes)
+            )
+
+        # phpBB3 bots are case insensitive substrings, with * wildcards
+        self._agent_pattern = None  # type: typing.Optional[typing.Pattern]
+        if self.agents:
+            self._agent_pattern = re.compile(
+                u'|'.join(
+                    re.escape(i).replace(u'\\*', u'.*?')
+                    for i in self.agents
+                ),
+                re.IGNORECASE,
+            )
+
+        self._verdicts = flask_phpbb3.cache.LocalCache(
+            max_size=BOT_VERDICT_CACHE_SIZE
+        )
+
+    def match(self, user_agent):
+        # type: (str) -> bool
+        verdict = self._verdicts.get(user_agent)  # type: typing.Optional[bool]
+        if verdict is None:
+            verdict = bool(
+                self._prefix_pattern
+                and self._prefix_pattern.match(user_agent)
+                or self._agent_pattern
+                and self._agent_pattern.search(user_agent)
+            )
+            self._verdicts.set(user_agent, verdict)
+        return verdict
 
 
 class PhpBB3Session(dict, flask.sessions.SessionMixin):
@@ -21,7 +84,10 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
         # Some session related variables
         self.modified = False
         self.new = False
-        self._read_only_properties = set([])  # type: set
+        self._read_only_properties = set([])  # type: typing.AbstractSet[str]
+
+        # Whether user columns were left out of session query
+        self._partial = False
 
         # Some ACL related things
         self._acl = None\
@@ -44,6 +110,27 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
         super(PhpBB3Session, self).__delitem__(key)
         self.modified = True
 
+    def __missing__(self, key):
+        # type: (str) -> typing.Any
+        """Loads user columns, which were left out of session query."""
+        if not self._partial:
+            raise KeyError(key)
+        self._partial = False
+
+        config = flask.current_app.config['PHPBB3_SESSION_BACKEND']
+        cache_ttl = config['SESSION_CACHE_TTL']
+        user = self._phpbb3.get_user(
+            user_id=self['user_id'],
+            cache=bool(cache_ttl),
+            cache_ttl=cache_ttl,
+        ) or {}
+        for user_key, value in user.items():
+            if not super(PhpBB3Session, self).__contains__(user_key):
+                super(PhpBB3Session, self).__setitem__(user_key, value)
+        self._read_only_properties = self._read_only_properties | set(user)
+
+        return self[key]
+
     @property
     def _phpbb3(self):
         # type: () -> flask_phpbb3.PhpBB3
@@ -108,6 +195,13 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
             self._acl = self._phpbb3.get_user_acl(self['user_permissions'])
         return self._acl.has_privileges(*options, forum_id=forum_id)
 
+    def forums_with_privilege(self, *options):
+        # type: (*str) -> typing.FrozenSet[int]
+        """Returns ids of forums, where user has any of privileges."""
+        if not self._acl:
+            self._acl = self._phpbb3.get_user_acl(self['user_permissions'])
+        return self._acl.forums_with_privilege(*options)
+
     def get_link_hash(self, link):
         # type: (str) -> str
         """Returns link hash."""
@@ -137,9 +231,110 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
         return unread_count
 
 
+class LazyPhpBB3Session(MutableMapping, flask.sessions.SessionMixin):
+    """
+    Session, which is loaded once it is used for the first time. Proxies
+    an inner session, so code reading it as a mapping always loads it.
+    """
+    session_class = PhpBB3Session
+
+    def __init__(self, loader=None):
+        # type: (typing.Optional[typing.Callable]) -> None
+        self._loader = loader
+        self._session = self.session_class()
+
+    def _ensure_loaded(self):
+        # type: () -> PhpBB3Session
+        loader = self._loader
+        if loader is not None:
+            # Loader fills the inner session through its accessors
+            self._loader = None
+            loader(self._session)
+        return self._session
+
+    @property
+    def is_loaded(self):
+        # type: () -> bool
+        return self._loader is None
+
+    # Not loaded session is not modified
+    @property
+    def modified(self):
+        # type: () -> bool
+        return self._session.modified
+
+    @modified.setter
+    def modified(self, value):
+        # type: (bool) -> None
+        self._session.modified = value
+
+    @property
+    def new(self):
+        # type: () -> bool
+        return self._session.new
+
+    def __getattr__(self, name):
+        # type: (str) -> typing.Any
+        if name in ('_loader', '_session'):
+            raise AttributeError(name)
+        return getattr(self._ensure_loaded(), name)
+
+    def __getitem__(self, key):
+        # type: (str) -> typing.Any
+        return self._ensure_loaded()[key]
+
+    def __setitem__(self, key, value):
+        # type: (str, typing.Any) -> None
+        self._ensure_loaded()[key] = value
+
+    def __delitem__(self, key):
+        # type: (str) -> None
+        del self._ensure_loaded()[key]
+
+    def __iter__(self):
+        # type: () -> typing.Iterator[str]
+        return iter(self._ensure_loaded())
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._ensure_loaded())
+
+    def __contains__(self, key):
+        # type: (typing.Any) -> bool
+        # Unlike item access, does not load left out user columns
+        return key in self._ensure_loaded()
+
+    def get(self, key, default=None):
+        # type: (str, typing.Any) -> typing.Any
+        return self._ensure_loaded().get(key, default)
+
+    def __repr__(self):
+        # type: () -> str
+        return repr(self._ensure_loaded())
+
+
 class PhpBB3SessionInterface(flask.sessions.SessionInterface):
     """A read-only session interface to access phpBB3 session."""
     session_class = PhpBB3Session
+    lazy_session_class = LazyPhpBB3Session
+
+    def __init__(self):
+        # type: () -> None
+        # Per worker cache of phpBB3 sessions
+        self._local_sessions = flask_phpbb3.cache.LocalCache(
+            max_size=LOCAL_SESSION_CACHE_SIZE
+        )
+        # Per worker cache of session ids, which were not found
+        self._unknown_sessions = flask_phpbb3.cache.LocalCache(
+            max_size=UNKNOWN_SESSION_CACHE_SIZE
+        )
+        # Per worker anonymous user and its keys, shared by sessions
+        self._anonymous_user = flask_phpbb3.cache.LocalCache(
+            max_size=1,
+            default_ttl=LOCAL_ANONYMOUS_CACHE_TTL,
+        )
+        self._bot_matcher = BotMatcher([])
+        self._bots_loaded_at = 0.0
 
     @classmethod
     def _cache(cls, app):
@@ -147,18 +342,143 @@ class PhpBB3SessionInterface(flask.sessions.SessionInterface):
         output = app.phpbb3_cache  # type: werkzeug.contrib.cache.BaseCache
         return output
 
+    def _get_bot_matcher(self, app):
+        # type: (flask.Flask) -> BotMatcher
+        """Returns bot matcher, rebuilt only when bot list changes."""
+        matcher = self._bot_matcher
+        prefixes = app.config['PHPBB3_BOTLIST']
+
+        agents = []  # type: typing.List[str]
+        if app.config['PHPBB3_BOTLIST_DATABASE']:
+            agents = matcher.agents
+            if self._bots_loaded_at + BOTLIST_REFRESH_INTERVAL <= time.time():
+                self._bots_loaded_at = time.time()
+                bots = app.phpbb3.execute_custom(
+                    'fetch_bots',
+                    cache=True,
+                    cache_ttl=BOTLIST_CACHE_TTL,
+                    limit=None,
+                )
+                agents = [bot['bot_agent'] for bot in bots or []]
+
+        if matcher.prefixes != list(prefixes) or matcher.agents != agents:
+            matcher = self._bot_matcher = BotMatcher(prefixes, agents)
+        return matcher
+
     def _is_bot(self, app, request):
-        for user_agent in app.config['PHPBB3_BOTLIST']:
-            if request.headers.get('User-Agent', '').startswith(user_agent):
-                return True
-        return False
+        # type: (flask.Flask, flask.wrappers.Request) -> bool
+        user_agent = request.headers.get('User-Agent', '')
+        return self._get_bot_matcher(app).match(user_agent)
 
-    def open_session(self, app, request):
-        # type: (flask.Flask, flask.wrappers.Request) -> PhpBB3Session
-        cookie_name = app.config.get('PHPBB3_COOKIE_NAME', 'phpbb3_')
+    @classmethod
+    def _is_fresh(cls, app, user):
+        # type: (flask.Flask, dict) -> bool
+        """Tests if session_time of a (cached) session is still valid."""
+        session_time = user.get('session_time')
+        if session_time is None:
+            return True
+
+        session_length =\
+            app.config['PHPBB3_SESSION_BACKEND']['SESSION_LENGTH']
+        output = int(session_time) + session_length > time.time()  # type: bool
+        return output
 
+    def _get_session(
+        self,
+        app,  # type: flask.Flask
+        phpbb3,  # type: flask_phpbb3.PhpBB3
+        session_id,  # type: str
+    ):
+        # type: (...) -> typing.Optional[dict]
+        """Fetches phpBB3 session, worker memory and cache are tried first."""
+        config = app.config['PHPBB3_SESSION_BACKEND']
+        local_ttl = config['LOCAL_SESSION_CACHE_TTL']
+        cache_ttl = config['SESSION_CACHE_TTL']
+        unknown_ttl = config['UNKNOWN_SESSION_CACHE_TTL']
+
+        if unknown_ttl and session_id in self._unknown_sessions:
+            return None
+
+        user = None  # type: typing.Optional[dict]
+        if local_ttl:
+            user = self._local_sessions.get(session_id)
+            if user is not None:
+                if self._is_fresh(app, user):
+                    return user
+                self._local_sessions.delete(session_id)
+
+        if cache_ttl:
+            user = phpbb3.get_session(
+                session_id=session_id,
+                cache=True,
+                cache_ttl=cache_ttl,
+            )
+            if user and not self._is_fresh(app, user):
+                # phpBB3 has most likely updated session_time since
+                phpbb3.invalidate('get_session', session_id=session_id)
+                user = phpbb3.get_session(
+                    session_id=session_id,
+                    cache=True,
+                    cache_ttl=cache_ttl,
+                )
+        else:
+            user = phpbb3.get_session(session_id=session_id)
+
+        if user and isinstance(user.get('username'), bytes):
+            user['username'] = user['username'].decode('utf-8', 'ignore')
+
+        if user and local_ttl:
+            self._local_sessions.set(session_id, user, local_ttl)
+        elif not user and unknown_ttl:
+            self._unknown_sessions.set(session_id, True, unknown_ttl)
+        return user
+
+    def _get_anonymous_user(self, phpbb3):
+        # type: (flask_phpbb3.PhpBB3) -> typing.Tuple[dict, frozenset]
+        """Returns anonymous user with its keys, from worker memory if set."""
+        entry = self._anonymous_user.get(1)\
+            # type: typing.Optional[typing.Tuple[dict, frozenset]]
+        if entry is None:
+            user = phpbb3.get_user(
+                user_id=1,
+                cache=True,
+                cache_ttl=ANONYMOUS_CACHE_TTL
+            ) or {}
+            entry = (user, frozenset(user.keys()))
+            if user:
+                self._anonymous_user.set(1, entry)
+        return entry
+
+    def invalidate_session(self, app, session_id):
+        # type: (flask.Flask, str) -> None
+        """Drops cached phpBB3 session (of this worker and session backend)."""
+        self._local_sessions.delete(session_id)
+        self._unknown_sessions.delete(session_id)
+        app.phpbb3.invalidate('get_session', session_id=session_id)
+
+    def open_session(
+        self,
+        app,  # type: flask.Flask
+        request,  # type: flask.wrappers.Request
+    ):
+        # type: (...) -> typing.Union[PhpBB3Session, LazyPhpBB3Session]
         if not hasattr(app, 'phpbb3'):
             raise ValueError('App not properly configured, phpbb3 is missing!')
+
+        if app.config['PHPBB3_SESSION_BACKEND']['LAZY']:
+            # Nothing is fetched, unless view uses the session
+            return self.lazy_session_class(
+                functools.partial(self._load_session, app, request)
+            )
+
+        session = self.session_class()
+        self._load_session(app, request, session)
+        return session
+
+    def _load_session(self, app, request, session):
+        # type: (flask.Flask, flask.wrappers.Request, PhpBB3Session) -> None
+        """Fills session with phpBB3 user and locally stored data."""
+        cookie_name = app.config.get('PHPBB3_COOKIE_NAME', 'phpbb3_')
         phpbb3 = app.phpbb3  # type: flask_phpbb3.PhpBB3
 
         session_id = request.args.get('sid', type=str)\
@@ -167,28 +487,23 @@ class PhpBB3SessionInterface(flask.sessions.SessionInterface):
             session_id = None
 
         user = None
+        read_only_properties = None
         if self._is_bot(app, request):
             user = {'user_id': 1, 'username': 'Anonymous'}
         elif session_id:
             # Try to fetch session
-            user = phpbb3.get_session(session_id=session_id)
-            if user and 'username' in user:
-                user['username'] = user['username'].decode('utf-8', 'ignore')
+            user = self._get_session(app, phpbb3, session_id)
         if not user:
-            # Use anonymous user
-            user = phpbb3.get_user(
-                user_id=1,
-                cache=True,
-                cache_ttl=ANONYMOUS_CACHE_TTL
-            )
-
-        # Create session
-        session = self.session_class()
+            # Use anonymous user, its row is shared and copied shallowly
+            user, read_only_properties = self._get_anonymous_user(phpbb3)
 
         # Set session data
         if isinstance(user, dict) and user:
-            session._read_only_properties = set(user.keys())
+            session._read_only_properties =\
+                read_only_properties or set(user.keys())
             session.update(user)
+            session._partial = 'session_id' in user\
+                and bool(app.config['PHPBB3_DATABASE'].get('SESSION_COLUMNS'))
 
             # Read from local storage backend
             if 'session_id' in session:
@@ -204,10 +519,13 @@ class PhpBB3SessionInterface(flask.sessions.SessionInterface):
                 data = {}
             session.update(data)
 
-        return session
-
-    def save_session(self, app, session, response):
-        # type: (flask.Flask, PhpBB3Session, flask.wrappers.Response) -> None
+    def save_session(
+        self,
+        app,  # type: flask.Flask
+        session,  # type: typing.Union[PhpBB3Session, LazyPhpBB3Session]
+        response,  # type: flask.wrappers.Response
+    ):
+        # type: (...) -> None
         """Currenlty does nothing."""
         if session.modified and session._read_only_properties:
             # Store all 'storable' properties
@@ -1,11 +1,98 @@
 from __future__ import absolute_import
 
+import typing
 import unittest
 
 import flask_phpbb3.backends.base
 
 import mock
 
+import werkzeug.contrib.cache
+
+
+def _encode_permissions(bits):
+    # type: (str) -> str
+    """Encodes a string of bits the way phpBB3 stores them."""
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    output = ''
+    for j in range(0, len(bits), 31):
+        value = int(bits[j:j + 31].ljust(31, '0'), 2)
+        chunk = ''
+        while value:
+            value, digit = divmod(value, 36)
+            chunk = digits[digit] + chunk
+        output += chunk.rjust(6, '0')
+    return output
+
+
+class TestDecodeForum(unittest.TestCase):
+    def test_main(self):
+        # type: () -> None
+        bits = '1' + '0' * 30 + '0' * 30 + '1'
+        chunks = flask_phpbb3.backends.base.UserAcl._decode_forum(
+            _encode_permissions(bits)
+        )
+
+        self.assertEqual(list(chunks), [1 << 30, 1])
+
+    def test_phpbb3_chunk(self):
+        # type: () -> None
+        chunks = flask_phpbb3.backends.base.UserAcl._decode_forum('HRA0HS')
+
+        self.assertEqual(list(chunks), [int('HRA0HS', 36)])
+
+    def test_user_acl(self):
+        # type: () -> None
+        user_acl = flask_phpbb3.backends.base.UserAcl(
+            [],
+            _encode_permissions('1' + '0' * 30 + '0' * 30 + '1')
+            + '\n\n'
+            + _encode_permissions('01'),
+        )
+
+        self.assertEqual(list(user_acl._get_forum(0) or []), [1 << 30, 1])
+        self.assertIsNone(user_acl._get_forum(1))
+        self.assertEqual(list(user_acl._get_forum(2) or []), [1 << 29])
+        self.assertEqual(sorted(user_acl._acl.keys()), [0, 2])
+
+
+class TestUserAclLazy(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.user_acl = flask_phpbb3.backends.base.UserAcl(
+            [{'auth_option': 'm_edit', 'is_local': 1, 'is_global': 1}],
+            '\n'.join([
+                _encode_permissions('0'),
+                _encode_permissions('0'),
+                '',
+                _encode_permissions('1'),
+            ])
+        )
+
+    def test_global_decoded(self):
+        # type: () -> None
+        self.assertEqual(list(self.user_acl._acl.keys()), [0])
+
+        self.user_acl.has_privilege('m_edit')
+        self.assertEqual(list(self.user_acl._acl.keys()), [0])
+
+    def test_forum_decoded_once(self):
+        # type: () -> None
+        self.assertTrue(self.user_acl.has_privilege('m_edit', forum_id=3))
+        self.assertEqual(sorted(self.user_acl._acl.keys()), [0, 3])
+
+        chunks = self.user_acl._acl[3]
+        self.assertTrue(self.user_acl.has_privilege('m_edit', forum_id=3))
+        self.assertIs(self.user_acl._acl[3], chunks)
+
+    def test_missing_forum(self):
+        # type: () -> None
+        for forum_id in (2, 4, -1):
+            self.assertFalse(
+                self.user_acl.has_privilege('m_edit', forum_id=forum_id)
+            )
+        self.assertEqual(list(self.user_acl._acl.keys()), [0])
+
 
 class TestSessionHasPrivilege(unittest.TestCase):
     def setUp(self):
@@ -18,7 +105,17 @@ class TestSessionHasPrivilege(unittest.TestCase):
         user_acl['0'][3] = '1'
         user_acl['5'][3] = '1'
 
-        self.user_acl = flask_phpbb3.backends.base.UserAcl([], '')
+        self.user_acl = flask_phpbb3.backends.base.UserAcl(
+            [],
+            '\n'.join([
+                _encode_permissions(''.join(user_acl['0'])),
+                '',
+                '',
+                '',
+                '',
+                _encode_permissions(''.join(user_acl['5'])),
+            ])
+        )
         self.user_acl._acl_options = {
             'local': {
                 'm_edit': 0,
@@ -34,11 +131,6 @@ class TestSessionHasPrivilege(unittest.TestCase):
             },
         }
 
-        self.user_acl._acl = {
-            '0': ''.join(user_acl['0']),
-            '5': ''.join(user_acl['5']),
-        }
-
     def test_existing(self):
         # type: () -> None
         actual_result = self.user_acl.has_privilege(
@@ -119,6 +211,40 @@ class TestSessionHasPrivilege(unittest.TestCase):
         )
         self.assertFalse(actual_result)
 
+    def test_memoized(self):
+        # type: () -> None
+        with mock.patch.object(
+            self.user_acl,
+            '_lookup',
+            wraps=self.user_acl._lookup,
+        ) as mocked_lookup:
+            self.assertTrue(self.user_acl.has_privilege('m_review', 5))
+            self.assertTrue(self.user_acl.has_privilege('m_review', '5'))
+            self.assertFalse(self.user_acl.has_privilege('!m_review', 5))
+
+        mocked_lookup.assert_called_once_with('m_review', 5)
+
+    def test_memo_bounded(self):
+        # type: () -> None
+        for forum_id in range(6, 1000):
+            self.assertFalse(self.user_acl.has_privilege('m_review', forum_id))
+        self.assertFalse(self.user_acl.has_privilege('m_review', -1))
+        self.assertEqual(self.user_acl._acl_lookup_cache, {})
+
+        self.assertTrue(self.user_acl.has_privilege('m_edit', 999))
+
+    def test_invalid_forum(self):
+        # type: () -> None
+        for forum_id in ('abc', '', None):
+            has_privilege = self.user_acl.has_privilege  # type: typing.Any
+            # Global permissions still apply, local ones do not
+            self.assertTrue(has_privilege('m_edit', forum_id))
+            self.assertFalse(has_privilege('!m_edit', forum_id))
+            self.assertTrue(has_privilege('m_delete', forum_id))
+            self.assertFalse(has_privilege('m_review', forum_id))
+            self.assertTrue(has_privilege('!m_review', forum_id))
+        self.assertEqual(self.user_acl._acl_lookup_cache, {})
+
     def test_out_of_bound(self):
         # type: () -> None
         actual_result = self.user_acl.has_privilege(
@@ -152,6 +278,82 @@ class TestSessionHasPrivilege(unittest.TestCase):
         self.assertFalse(actual_result)
 
 
+class TestForumsWithPrivilege(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        # f_read is bit 0, f_post bit 40 (second chunk), u_search global 0
+        self.user_acl = flask_phpbb3.backends.base.UserAcl(
+            [
+                {'auth_option': 'f_read', 'is_local': 1, 'is_global': 0},
+                {'auth_option': 'u_search', 'is_local': 0, 'is_global': 1},
+            ] + [
+                {'auth_option': 'f_' + str(i), 'is_local': 1, 'is_global': 0}
+                for i in range(39)
+            ] + [
+                {'auth_option': 'f_post', 'is_local': 1, 'is_global': 0},
+            ],
+            '\n'.join([
+                _encode_permissions('0'),
+                _encode_permissions('1'),
+                _encode_permissions('1' + '0' * 39 + '1'),
+                '',
+                _encode_permissions('0' * 40 + '1'),
+                _encode_permissions('0'),
+            ])
+        )
+
+    def test_local(self):
+        # type: () -> None
+        self.assertEqual(
+            self.user_acl.forums_with_privilege('f_read'),
+            frozenset([1, 2]),
+        )
+        self.assertEqual(
+            self.user_acl.forums_with_privilege('f_post'),
+            frozenset([2, 4]),
+        )
+        self.assertEqual(
+            self.user_acl.forums_with_privilege('f_read', 'f_post'),
+            frozenset([1, 2, 4]),
+        )
+
+    def test_matches_has_privilege(self):
+        # type: () -> None
+        for option in ('f_read', 'f_post', 'f_3', 'u_search', 'unknown'):
+            self.assertEqual(
+                self.user_acl.forums_with_privilege(option),
+                frozenset(
+                    forum_id
+                    for forum_id in range(1, 6)
+                    if self.user_acl.has_privilege(option, forum_id)
+                ),
+            )
+
+    def test_global(self):
+        # type: () -> None
+        user_acl = flask_phpbb3.backends.base.UserAcl(
+            [{'auth_option': 'm_edit', 'is_local': 1, 'is_global': 1}],
+            '\n'.join([
+                _encode_permissions('1'),
+                _encode_permissions('0'),
+                _encode_permissions('1'),
+            ])
+        )
+
+        self.assertEqual(
+            user_acl.forums_with_privilege('m_edit'),
+            frozenset([1, 2]),
+        )
+
+    def test_negated(self):
+        # type: () -> None
+        self.assertRaises(
+            ValueError,
+            self.user_acl.forums_with_privilege,
+            '!f_read',
+        )
+
+
 class TestSessionHasPrivileges(unittest.TestCase):
     def setUp(self):
         # type: () -> None
@@ -181,6 +383,13 @@ class TestSessionHasPrivileges(unittest.TestCase):
         actual_result = self.user_acl.has_privileges(*privileges)
         self.assertTrue(actual_result)
 
+    @mock.patch('flask_phpbb3.backends.base.UserAcl.has_privilege',
+                return_value=True)
+    def test_short_circuit(self, has_privilege_mock):
+        # type: (mock.Mock) -> None
+        self.assertTrue(self.user_acl.has_privileges('m_edit', 'm_delete'))
+        has_privilege_mock.assert_called_once_with('m_edit', forum_id=0)
+
     @mock.patch('flask_phpbb3.backends.base.UserAcl.has_privilege',
                 return_value=False)
     def test_per_forum(self, has_privilege_mock):
@@ -201,3 +410,341 @@ class TestSessionHasPrivileges(unittest.TestCase):
             mock.call('m_delete', forum_id=2),
             mock.call('m_view', forum_id=2),
         ], any_order=True)
+
+
+class TestCached(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.cache = werkzeug.contrib.cache.SimpleCache()
+        self.config = {
+            'TABLE_PREFIX': '',
+            'CACHE_STALE_TTL': 60,
+            'CACHE_LOCK_TTL': 10,
+        }
+        self.backend = flask_phpbb3.backends.base.BaseBackend(
+            self.cache,
+            self.config,
+            flask_phpbb3.backends.base.StatementRegistry({}),
+        )
+        self.loader = mock.Mock(return_value={'key': 'value'})
+
+    def test_miss(self):
+        # type: () -> None
+        for _ in range(2):
+            actual_result = self.backend._cached('key', 10, self.loader)
+            self.assertEqual(actual_result, {'key': 'value'})
+
+        self.loader.assert_called_once_with()
+        self.assertIsNone(self.cache.get('key:lock'))
+
+    @mock.patch('flask_phpbb3.backends.base.time.time')
+    def test_stale_refresh(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        self.backend._cached('key', 10, self.loader)
+
+        mocked_time.return_value = 120
+        self.loader.return_value = {'key': 'new_value'}
+        actual_result = self.backend._cached('key', 10, self.loader)
+
+        self.assertEqual(actual_result, {'key': 'new_value'})
+        self.assertEqual(self.loader.call_count, 2)
+
+    @mock.patch('flask_phpbb3.backends.base.time.time')
+    def test_stale_locked(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        self.backend._cached('key', 10, self.loader)
+
+        # Other process is refreshing it
+        self.cache.add('key:lock', 1)
+        mocked_time.return_value = 120
+        actual_result = self.backend._cached('key', 10, self.loader)
+
+        self.assertEqual(actual_result, {'key': 'value'})
+        self.loader.assert_called_once_with()
+
+    @mock.patch('flask_phpbb3.backends.base.time.time')
+    def test_stale_locked_in_process(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.config['CACHE_LOCK_TTL'] = 0
+        mocked_time.return_value = 100
+        self.backend._cached('key', 10, self.loader)
+
+        # Other thread is refreshing it
+        mocked_time.return_value = 120
+        with flask_phpbb3.backends.base._cache_key_locks.lock('key'):
+            actual_result = self.backend._cached('key', 10, self.loader)
+
+        self.assertEqual(actual_result, {'key': 'value'})
+        self.loader.assert_called_once_with()
+
+    def test_lease_taken_over(self):
+        # type: () -> None
+        token = self.backend._acquire_lease('key')
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.backend._acquire_lease('key'))
+
+        # Lease expired and other process took it
+        self.cache.set('key:lock', 'other')
+        self.backend._release_lease('key', token)
+        self.assertEqual(self.cache.get('key:lock'), 'other')
+
+        self.cache.set('key:lock', token)
+        self.backend._release_lease('key', token)
+        self.assertIsNone(self.cache.get('key:lock'))
+
+    @mock.patch('flask_phpbb3.backends.base.time.sleep')
+    def test_miss_locked(self, mocked_sleep):
+        # type: (mock.Mock) -> None
+        self.cache.add('key:lock', 1)
+
+        def other_process_loads(interval):
+            # type: (float) -> None
+            self.backend._cache_set('key', {'key': 'other'}, 10)
+        mocked_sleep.side_effect = other_process_loads
+
+        actual_result = self.backend._cached('key', 10, self.loader)
+
+        self.assertEqual(actual_result, {'key': 'other'})
+        self.loader.assert_not_called()
+
+    @mock.patch('flask_phpbb3.backends.base.time.sleep')
+    def test_miss_lock_released(self, mocked_sleep):
+        # type: (mock.Mock) -> None
+        self.cache.add('key:lock', 1)
+
+        def other_process_fails(interval):
+            # type: (float) -> None
+            self.cache.delete('key:lock')
+        mocked_sleep.side_effect = other_process_fails
+
+        actual_result = self.backend._cached('key', 10, self.loader)
+
+        self.assertEqual(actual_result, {'key': 'value'})
+        self.loader.assert_called_once_with()
+
+
+class TestGetUserAcl(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        flask_phpbb3.backends.base._user_acls.clear()
+        flask_phpbb3.backends.base._acl_options.clear()
+        self.backend = flask_phpbb3.backends.base.BaseBackend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {'TABLE_PREFIX': ''},
+            flask_phpbb3.backends.base.StatementRegistry({}),
+        )
+        self.acl_options = [
+            {'auth_option': 'm_edit', 'is_local': 1, 'is_global': 1},
+        ]
+        self.backend.execute = mock.Mock(  # type: ignore
+            side_effect=lambda *args, **kwargs: list(self.acl_options),
+        )
+
+    def test_shared(self):
+        # type: () -> None
+        user_acl = self.backend.get_user_acl('HRA0HS')
+
+        self.assertIs(self.backend.get_user_acl('HRA0HS'), user_acl)
+        self.assertIsNot(self.backend.get_user_acl('000000'), user_acl)
+
+    @mock.patch('flask_phpbb3.backends.base.time.time')
+    def test_acl_options_changed(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        user_acl = self.backend.get_user_acl('HRA0HS')
+        self.assertTrue(user_acl.has_privilege('m_edit'))
+
+        self.acl_options.insert(
+            0,
+            {'auth_option': 'm_view', 'is_local': 1, 'is_global': 1},
+        )
+        user_acl = self.backend.get_user_acl('HRA0HS')
+        self.assertTrue(user_acl.has_privilege('m_edit'))
+
+        mocked_time.return_value = 100\
+            + flask_phpbb3.backends.base.ACL_OPTIONS_REFRESH_INTERVAL
+        user_acl = self.backend.get_user_acl('HRA0HS')
+        self.assertFalse(user_acl.has_privilege('m_edit'))
+
+    @mock.patch('flask_phpbb3.backends.base.time.time')
+    def test_acl_options_shared(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        acl_options = self.backend._get_acl_options()
+        self.assertIs(self.backend._get_acl_options(), acl_options)
+        self.assertEqual(self.backend.execute.call_count, 1)
+
+        # Unchanged options keep the same index
+        mocked_time.return_value = 100\
+            + flask_phpbb3.backends.base.ACL_OPTIONS_REFRESH_INTERVAL
+        self.assertIs(self.backend._get_acl_options(), acl_options)
+        self.assertEqual(self.backend.execute.call_count, 2)
+
+    @mock.patch('flask_phpbb3.backends.base.time.time')
+    def test_acl_options_refreshing(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        acl_options = self.backend._get_acl_options()
+
+        # Other thread is refreshing it
+        mocked_time.return_value = 100\
+            + flask_phpbb3.backends.base.ACL_OPTIONS_REFRESH_INTERVAL
+        with flask_phpbb3.backends.base._acl_options_lock:
+            self.assertIs(self.backend._get_acl_options(), acl_options)
+        self.assertEqual(self.backend.execute.call_count, 1)
+
+
+class TestAclOptions(unittest.TestCase):
+    def test_main(self):
+        # type: () -> None
+        acl_options = flask_phpbb3.backends.base.AclOptions([
+            {'auth_option': 'm_edit', 'is_local': 1, 'is_global': 1},
+            {'auth_option': 'u_search', 'is_local': 0, 'is_global': 1},
+            {'auth_option': 'f_read', 'is_local': 1, 'is_global': 0},
+        ])
+
+        self.assertEqual(acl_options['local'], {'m_edit': 0, 'f_read': 1})
+        self.assertEqual(acl_options['global'], {'m_edit': 0, 'u_search': 1})
+
+    def test_version(self):
+        # type: () -> None
+        raw_acl_options = [
+            {'auth_option': 'm_edit', 'is_local': 1, 'is_global': 1},
+            {'auth_option': 'm_view', 'is_local': 1, 'is_global': 1},
+        ]
+
+        version = flask_phpbb3.backends.base.AclOptions(
+            raw_acl_options
+        ).version
+        self.assertEqual(
+            flask_phpbb3.backends.base.AclOptions(
+                [dict(i) for i in raw_acl_options]
+            ).version,
+            version,
+        )
+        self.assertNotEqual(
+            flask_phpbb3.backends.base.AclOptions(
+                list(reversed(raw_acl_options))
+            ).version,
+            version,
+        )
+
+
+class TestPageCursor(unittest.TestCase):
+    def test_roundtrip(self):
+        # type: () -> None
+        for value in (1, 2 ** 40, u'user\u010d', None):
+            cursor = flask_phpbb3.backends.base.encode_page_cursor(value)
+
+            self.assertIsInstance(cursor, str)
+            self.assertEqual(
+                flask_phpbb3.backends.base.decode_page_cursor(cursor),
+                value,
+            )
+
+    def test_invalid(self):
+        # type: () -> None
+        for cursor in ('', '!', 'e30', 'WzEsMl0'):
+            self.assertRaises(
+                ValueError,
+                flask_phpbb3.backends.base.decode_page_cursor,
+                cursor,
+            )
+
+
+class TestExecutePage(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.backend = flask_phpbb3.backends.base.BaseBackend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {'TABLE_PREFIX': ''},
+            flask_phpbb3.backends.base.StatementRegistry({
+                'fetch_members': flask_phpbb3.backends.base.Statement(
+                    'fetch_members',
+                    'SELECT * FROM users',
+                    '',
+                ),
+                'get_user': flask_phpbb3.backends.base.Statement(
+                    'get_user',
+                    'SELECT * FROM users WHERE user_id = %(user_id)s',
+                    '',
+                ),
+            }),
+        )
+        self.backend._fetch_page = mock.Mock(  # type: ignore
+            return_value=[{'user_id': 3}, {'user_id': 7}],
+        )
+
+    def test_first_page(self):
+        # type: () -> None
+        rows, cursor = self.backend.execute_page(
+            'fetch_members',
+            'user_id',
+            limit=2,
+        )
+
+        self.assertEqual(rows, [{'user_id': 3}, {'user_id': 7}])
+        self.assertEqual(
+            flask_phpbb3.backends.base.decode_page_cursor(cursor),
+            7,
+        )
+        self.backend._fetch_page.assert_called_once_with(
+            self.backend._functions['fetch_members'],
+            'user_id',
+            {},
+            False,
+            None,
+            2,
+        )
+
+    def test_next_page(self):
+        # type: () -> None
+        cursor = flask_phpbb3.backends.base.encode_page_cursor(7)
+
+        rows, cursor = self.backend.execute_page(
+            'fetch_members',
+            'user_id',
+            cursor,
+            limit=3,
+            group_id=2,
+        )
+
+        self.assertIsNone(cursor)
+        self.backend._fetch_page.assert_called_once_with(
+            self.backend._functions['fetch_members'],
+            'user_id',
+            {'group_id': 2},
+            True,
+            7,
+            3,
+        )
+
+    def test_cached(self):
+        # type: () -> None
+        for _ in range(2):
+            self.backend.execute_page(
+                'fetch_members',
+                'user_id',
+                limit=2,
+                cache=True,
+            )
+        self.backend._fetch_page.assert_called_once()
+
+    def test_invalid(self):
+        # type: () -> None
+        self.assertRaises(
+            ValueError,
+            self.backend.execute_page,
+            'get_user',
+            'user_id',
+            user_id=2,
+        )
+        self.assertRaises(
+            ValueError,
+            self.backend.execute_page,
+            'fetch_members',
+            'user_id',
+            limit=None,
+        )
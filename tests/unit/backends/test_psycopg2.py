@@ -1,11 +1,15 @@
 from __future__ import absolute_import
 
+import datetime
 import unittest
 
 import flask_phpbb3.backends.psycopg2
 
 import mock
 
+import psycopg2.extensions
+import psycopg2.pool
+
 import werkzeug.contrib.cache
 
 
@@ -24,7 +28,8 @@ class TestExecuteOperation(unittest.TestCase):
         # type: (mock.Mock) -> None
         parameters = mock.Mock()
         cursor = mock.Mock()
-        cursor.fetchone.return_value = {'key': 'value'}
+        cursor.description = [('key',)]
+        cursor.fetchone.return_value = ('value',)
         mocked_db.cursor.return_value = cursor
 
         actual_value = self.connection._execute_operation(
@@ -71,7 +76,8 @@ class TestExecuteOperation(unittest.TestCase):
         # type: (mock.Mock) -> None
         expected_value = [{'key': 1}, {'key': 2}]
         cursor = mock.Mock()
-        cursor.__iter__ = mock.Mock(return_value=iter(expected_value))
+        cursor.description = [('key',)]
+        cursor.__iter__ = mock.Mock(return_value=iter([(1,), (2,)]))
         mocked_db.cursor.return_value = cursor
 
         actual_value = self.connection._execute_operation(
@@ -108,6 +114,151 @@ class TestExecuteOperation(unittest.TestCase):
         self.assertIsNone(actual_value)
 
 
+class TestPreparedQuery(unittest.TestCase):
+    def test_positional(self):
+        # type: () -> None
+        prepared = flask_phpbb3.backends.psycopg2.PreparedQuery(
+            'select * from t where a = %(a)s and b = %(b)s or c = %(a)s'
+            " and d like 'x%%'",
+            False,
+        )
+
+        self.assertEqual(
+            prepared.query,
+            'select * from t where a = $1 and b = $2 or c = $1'
+            " and d like 'x%'",
+        )
+        self.assertEqual(prepared.parameters, ['a', 'b'])
+        self.assertEqual(
+            prepared.prepare,
+            'PREPARE ' + prepared.name + ' AS ' + prepared.query,
+        )
+        self.assertEqual(
+            prepared.execute,
+            'EXECUTE ' + prepared.name + ' (%s, %s)',
+        )
+        self.assertEqual(prepared.values({'a': 1, 'b': 2}), [1, 2])
+
+    def test_paginate(self):
+        # type: () -> None
+        prepared = flask_phpbb3.backends.psycopg2.PreparedQuery(
+            'select * from t where a = %(a)s',
+            True,
+        )
+
+        self.assertEqual(
+            prepared.query,
+            'select * from t where a = $1 OFFSET $2 LIMIT $3',
+        )
+        self.assertEqual(
+            prepared.values({'a': 1}, skip=5, limit=None),
+            [1, 5, None],
+        )
+
+    def test_no_parameters(self):
+        # type: () -> None
+        prepared = flask_phpbb3.backends.psycopg2.PreparedQuery(
+            'select 1',
+            False,
+        )
+
+        self.assertEqual(prepared.execute, 'EXECUTE ' + prepared.name)
+
+
+class TestStatement(unittest.TestCase):
+    def test_table_prefix(self):
+        # type: () -> None
+        statement = flask_phpbb3.backends.psycopg2.Psycopg2Statement(
+            'get_something',
+            'select * from {TABLE_PREFIX}users where user_id = %(user_id)s',
+            'phpbb_',
+        )
+
+        self.assertEqual(statement.operation, 'get')
+        self.assertEqual(
+            statement.query,
+            'select * from phpbb_users where user_id = %(user_id)s',
+        )
+        self.assertIsNone(statement.paginated_query)
+
+    def test_paginated(self):
+        # type: () -> None
+        statement = flask_phpbb3.backends.psycopg2.Psycopg2Statement(
+            'fetch_something',
+            'select * from {TABLE_PREFIX}users',
+            'phpbb_',
+        )
+
+        self.assertEqual(statement.operation, 'fetch')
+        self.assertEqual(
+            statement.paginated_query,
+            'select * from phpbb_users OFFSET %(_skip)s LIMIT %(_limit)s',
+        )
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
+class TestSqlQuery(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': 'phpbb_',
+                'CUSTOM_STATEMENTS': {
+                    'fetch_users': 'select * from {TABLE_PREFIX}users',
+                },
+            }
+        )
+
+    def test_paginate(self, mocked_db):
+        # type: (mock.Mock) -> None
+        cursor = mock.Mock()
+        cursor.description = [('user_id',)]
+        cursor.__iter__ = mock.Mock(return_value=iter([]))
+        mocked_db.cursor.return_value = cursor
+
+        self.connection.execute('fetch_users', skip=20, limit=0)
+
+        cursor.execute.assert_called_once_with(
+            'select * from phpbb_users OFFSET %(_skip)s LIMIT %(_limit)s',
+            {'_skip': 20, '_limit': None},
+        )
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
+class TestExecutePrepared(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': 'phpbb_',
+                'PREPARE': True,
+                'MEMOIZE': False,
+            }
+        )
+
+    def test_prepare_once(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.prepared_statements = set()
+        cursor = mock.Mock()
+        cursor.description = [('user_id',)]
+        cursor.fetchone.return_value = (2,)
+        mocked_db.cursor.return_value = cursor
+
+        for _ in range(2):
+            actual_value = self.connection.execute('get_user', user_id=2)
+            self.assertEqual(actual_value, {'user_id': 2})
+
+        prepared = self.connection._functions['get_user'].prepared
+        self.assertEqual(mocked_db.prepared_statements, set([prepared.name]))
+        cursor.execute.assert_has_calls([
+            mock.call(prepared.prepare),
+            mock.call(prepared.execute, [2]),
+            mock.call(prepared.execute, [2]),
+        ])
+
+
 @mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
 class TestPreparedCustomFieldsStatements(unittest.TestCase):
     def test_empty(self, mocked_db):
@@ -119,18 +270,20 @@ class TestPreparedCustomFieldsStatements(unittest.TestCase):
             }
         )
 
-        self.assertListEqual(
-            connection._functions.keys(),
-            [
+        self.assertSetEqual(
+            set(connection._functions.keys()),
+            set([
                 'has_membership_resolve',
                 'get_autologin',
                 'get_session',
                 'has_membership',
                 'fetch_acl_options',
+                'fetch_bots',
                 'get_unread_notifications_count',
                 'get_user',
+                'batch_get_user',
                 'get_user_profile',
-            ]
+            ]),
         )
 
     def test_valid(self, mocked_db):
@@ -151,9 +304,11 @@ class TestPreparedCustomFieldsStatements(unittest.TestCase):
                 'set_some_field',
                 'has_membership',
                 'fetch_acl_options',
+                'fetch_bots',
                 'set_another_field',
                 'get_unread_notifications_count',
                 'get_user',
+                'batch_get_user',
                 'get_user_profile',
             ]),
         )
@@ -170,18 +325,20 @@ class TestPreparedCustomStatements(unittest.TestCase):
             }
         )
 
-        self.assertListEqual(
-            connection._functions.keys(),
-            [
+        self.assertSetEqual(
+            set(connection._functions.keys()),
+            set([
                 'has_membership_resolve',
                 'get_autologin',
                 'get_session',
                 'has_membership',
                 'fetch_acl_options',
+                'fetch_bots',
                 'get_unread_notifications_count',
                 'get_user',
+                'batch_get_user',
                 'get_user_profile',
-            ]
+            ]),
         )
 
     def test_addition(self, mocked_db):
@@ -190,30 +347,64 @@ class TestPreparedCustomStatements(unittest.TestCase):
             {
                 'TABLE_PREFIX': '',
                 'CUSTOM_STATEMENTS': {
-                    'some_custom_statement': 'some query',
+                    'get_custom_statement': 'some query',
                 },
             }
         )
 
-        self.assertListEqual(
-            connection._functions.keys(),
-            [
+        self.assertSetEqual(
+            set(connection._functions.keys()),
+            set([
                 'has_membership_resolve',
                 'get_autologin',
                 'get_session',
                 'has_membership',
                 'fetch_acl_options',
+                'fetch_bots',
                 'get_unread_notifications_count',
-                'some_custom_statement',
+                'get_custom_statement',
                 'get_user',
+                'batch_get_user',
                 'get_user_profile',
-            ]
+            ])
         )
         self.assertEqual(
-            connection._functions['some_custom_statement'],
+            connection._functions['get_custom_statement'].query,
             'some query',
         )
 
+    def test_unknown_prefix(self, mocked_db):
+        with self.assertRaises(ValueError):
+            flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+                werkzeug.contrib.cache.SimpleCache(),
+                {
+                    'TABLE_PREFIX': '',
+                    'CUSTOM_STATEMENTS': {
+                        'some_custom_statement': 'some query',
+                    },
+                }
+            )
+
+    def test_callable(self, mocked_db):
+        def some_custom_statement():
+            # type: () -> str
+            return 'result'
+
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': '',
+                'CUSTOM_STATEMENTS': {
+                    'some_custom_statement': some_custom_statement,
+                },
+            }
+        )
+
+        self.assertEqual(
+            connection.execute('some_custom_statement'),
+            'result',
+        )
+
     def test_override(self, mocked_db):
         connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
             werkzeug.contrib.cache.SimpleCache(),
@@ -225,20 +416,693 @@ class TestPreparedCustomStatements(unittest.TestCase):
             }
         )
 
-        self.assertListEqual(
-            connection._functions.keys(),
-            [
+        self.assertSetEqual(
+            set(connection._functions.keys()),
+            set([
                 'has_membership_resolve',
                 'get_autologin',
                 'get_session',
                 'has_membership',
                 'fetch_acl_options',
+                'fetch_bots',
                 'get_unread_notifications_count',
                 'get_user',
+                'batch_get_user',
                 'get_user_profile',
-            ]
+            ]),
         )
         self.assertEqual(
-            connection._functions['get_autologin'],
+            connection._functions['get_autologin'].query,
             'overriden',
         )
+
+
+class TestConnection(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.config = {
+            'TABLE_PREFIX': '',
+            'DATABASE': 'phpbb3',
+            'HOST': '127.0.0.1',
+            'USER': 'phpbb3',
+            'PASSWORD': '',
+        }
+
+    @mock.patch('flask_phpbb3.backends.psycopg2.psycopg2.connect')
+    def test_close_without_connection(self, mocked_connect):
+        # type: (mock.Mock) -> None
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+
+        connection.close()
+        self.assertFalse(connection.is_closed)
+        mocked_connect.assert_not_called()
+
+    @mock.patch('flask_phpbb3.backends.psycopg2.psycopg2.connect')
+    def test_close(self, mocked_connect):
+        # type: (mock.Mock) -> None
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+
+        db = connection._db
+        connection.close()
+        db.close.assert_called_once_with()
+
+    @mock.patch(
+        'flask_phpbb3.backends.psycopg2.psycopg2.extensions.get_wait_callback',
+        return_value=None,
+    )
+    @mock.patch(
+        'flask_phpbb3.backends.psycopg2.psycopg2.extensions.set_wait_callback'
+    )
+    @mock.patch('flask_phpbb3.backends.psycopg2.psycopg2.connect')
+    def test_green(self, mocked_connect, mocked_set, mocked_get):
+        # type: (mock.Mock, mock.Mock, mock.Mock) -> None
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+        connection._db
+        mocked_set.assert_not_called()
+
+        self.config['GREEN'] = True
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+        connection._db
+        mocked_set.assert_called_once_with(
+            flask_phpbb3.backends.psycopg2.psycopg2.extras.wait_select
+        )
+
+        # Custom callback
+        callback = mock.Mock()
+        mocked_set.reset_mock()
+        self.config['GREEN'] = callback
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+        connection._db
+        mocked_set.assert_called_once_with(callback)
+
+        # Already installed
+        mocked_set.reset_mock()
+        mocked_get.return_value = callback
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+        connection._db
+        mocked_set.assert_not_called()
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.psycopg2.connect')
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.config = {
+            'TABLE_PREFIX': '',
+            'DATABASE': 'phpbb3',
+            'HOST': '127.0.0.1',
+            'USER': 'phpbb3',
+            'PASSWORD': '',
+            'POOL': {
+                'MIN_SIZE': 0,
+                'MAX_SIZE': 2,
+            },
+        }
+
+    def tearDown(self):
+        # type: () -> None
+        flask_phpbb3.backends.psycopg2._pools.clear()
+
+    def _create_connection(self):
+        # type: () -> mock.Mock
+        connection = mock.Mock()
+        connection.closed = 0
+        connection.get_transaction_status.return_value =\
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return connection
+
+    def _create_backend(self):
+        # type: () -> flask_phpbb3.backends.psycopg2.Psycopg2Backend
+        return flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+
+    def test_reuse(self, mocked_connect):
+        # type: (mock.Mock) -> None
+        db = self._create_connection()
+        mocked_connect.return_value = db
+
+        backend = self._create_backend()
+        self.assertIs(backend._db, db)
+        backend.close()
+        db.close.assert_not_called()
+
+        backend = self._create_backend()
+        self.assertIs(backend._db, db)
+        mocked_connect.assert_called_once()
+
+    def test_reset_on_return(self, mocked_connect):
+        # type: (mock.Mock) -> None
+        db = self._create_connection()
+        mocked_connect.return_value = db
+
+        backend = self._create_backend()
+        _ = backend._db
+        db.get_transaction_status.return_value =\
+            psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        backend.close()
+
+        db.rollback.assert_called_once_with()
+        db.close.assert_not_called()
+
+    def test_broken_on_checkout(self, mocked_connect):
+        # type: (mock.Mock) -> None
+        broken_db = self._create_connection()
+        healthy_db = self._create_connection()
+        mocked_connect.side_effect = [broken_db, healthy_db]
+
+        backend = self._create_backend()
+        _ = backend._db
+        backend.close()
+
+        broken_db.closed = 1
+        backend = self._create_backend()
+        self.assertIs(backend._db, healthy_db)
+
+    def test_exhausted(self, mocked_connect):
+        # type: (mock.Mock) -> None
+        mocked_connect.side_effect = [
+            self._create_connection(),
+            self._create_connection(),
+        ]
+        self.config['POOL']['TIMEOUT'] = 0
+
+        for _ in range(2):
+            _ = self._create_backend()._db
+        with self.assertRaises(psycopg2.pool.PoolError):
+            _ = self._create_backend()._db
+
+
+class TestStatementRegistry(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.config = {
+            'TABLE_PREFIX': 'phpbb_',
+        }
+        self.statements =\
+            flask_phpbb3.backends.psycopg2.Psycopg2Backend.create_registry(
+                self.config
+            )
+
+    def test_shared(self):
+        # type: () -> None
+        first = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+            self.statements,
+        )
+        second = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+            self.statements,
+        )
+
+        self.assertIs(first._functions, self.statements)
+        self.assertIs(second._functions, self.statements)
+
+    def test_immutable(self):
+        # type: () -> None
+        with self.assertRaises(TypeError):
+            self.statements['get_user'] = 'select 1'  # type: ignore
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
+class TestCacheKey(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.cache = werkzeug.contrib.cache.SimpleCache()
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            self.cache,
+            {
+                'TABLE_PREFIX': 'phpbb_',
+            }
+        )
+
+    def test_version(self, mocked_db):
+        # type: (mock.Mock) -> None
+        other_connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            self.cache,
+            {
+                'TABLE_PREFIX': 'other_',
+            }
+        )
+
+        self.assertNotEqual(
+            self.connection._cache_key('get_user', {'user_id': 2}),
+            other_connection._cache_key('get_user', {'user_id': 2}),
+        )
+
+    def test_pages(self, mocked_db):
+        # type: (mock.Mock) -> None
+        self.assertNotEqual(
+            self.connection._cache_key('fetch_acl_options', {}, 0, 10),
+            self.connection._cache_key('fetch_acl_options', {}, 10, 10),
+        )
+
+    def test_invalidate(self, mocked_db):
+        # type: (mock.Mock) -> None
+        cursor = mock.Mock()
+        cursor.description = [('user_id',)]
+        cursor.fetchone.return_value = (2,)
+        mocked_db.cursor.return_value = cursor
+
+        self.connection.execute('get_user', cache=True, user_id=2)
+        self.connection.execute('get_user', cache=True, user_id=2)
+        self.assertEqual(cursor.execute.call_count, 1)
+
+        self.connection.invalidate('get_user', user_id=2)
+        self.connection.execute('get_user', cache=True, user_id=2)
+        self.assertEqual(cursor.execute.call_count, 2)
+
+    def test_unsupported_argument(self, mocked_db):
+        # type: (mock.Mock) -> None
+        cursor = mock.Mock()
+        cursor.description = [('user_id',)]
+        cursor.fetchone.return_value = (2,)
+        mocked_db.cursor.return_value = cursor
+        connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            self.cache,
+            {
+                'TABLE_PREFIX': 'phpbb_',
+                'MEMOIZE': False,
+            }
+        )
+
+        # Call is not cached, but still executed
+        user_id = object()
+        connection.execute('get_user', cache=True, user_id=user_id)
+        connection.execute('get_user', cache=True, user_id=user_id)
+        self.assertEqual(cursor.execute.call_count, 2)
+        connection.invalidate('get_user', user_id=user_id)
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
+class TestExecuteBatch(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': 'phpbb_',
+            }
+        )
+        self.cursor = mock.Mock()
+        self.cursor.description = [('user_id',)]
+
+    def _setup_rows(self, mocked_db, rows):
+        # type: (mock.Mock, list) -> None
+        self.cursor.__iter__ = mock.Mock(return_value=iter(rows))
+        mocked_db.cursor.return_value = self.cursor
+
+    def test_single_query(self, mocked_db):
+        # type: (mock.Mock) -> None
+        self._setup_rows(mocked_db, [(2,), (3,)])
+
+        actual_result = self.connection.execute_batch(
+            'get_user',
+            'user_id',
+            [2, 3, 2, 4],
+        )
+
+        self.assertEqual(actual_result, {
+            2: {'user_id': 2},
+            3: {'user_id': 3},
+        })
+        self.cursor.execute.assert_called_once_with(
+            'SELECT * FROM phpbb_users WHERE user_id = ANY(%(user_id)s)',
+            {'user_id': [2, 3, 4]},
+        )
+
+    def test_shared_cache(self, mocked_db):
+        # type: (mock.Mock) -> None
+        self.cursor.fetchone.return_value = (2,)
+        self._setup_rows(mocked_db, [(3,)])
+
+        self.connection.execute('get_user', cache=True, user_id=2)
+        actual_result = self.connection.execute_batch(
+            'get_user',
+            'user_id',
+            [2, 3, 4],
+            cache=True,
+        )
+
+        self.assertEqual(actual_result, {
+            2: {'user_id': 2},
+            3: {'user_id': 3},
+        })
+        self.cursor.execute.assert_called_with(
+            'SELECT * FROM phpbb_users WHERE user_id = ANY(%(user_id)s)',
+            {'user_id': [3, 4]},
+        )
+
+        # All of them are cached now, also the missing one
+        self.cursor.reset_mock()
+        self.connection.execute_batch(
+            'get_user',
+            'user_id',
+            [2, 3, 4],
+            cache=True,
+        )
+        self.assertEqual(
+            self.connection.execute('get_user', cache=True, user_id=3),
+            {'user_id': 3},
+        )
+        self.cursor.execute.assert_not_called()
+
+    def test_empty(self, mocked_db):
+        # type: (mock.Mock) -> None
+        actual_result = self.connection.execute_batch(
+            'get_user',
+            'user_id',
+            [],
+        )
+
+        self.assertEqual(actual_result, {})
+        mocked_db.cursor.assert_not_called()
+
+
+class TestSessionColumns(unittest.TestCase):
+    def test_default(self):
+        # type: () -> None
+        self.assertEqual(
+            flask_phpbb3.backends.psycopg2.Psycopg2Backend._session_columns(
+                {}
+            ),
+            '*',
+        )
+
+    def test_columns(self):
+        # type: () -> None
+        self.assertEqual(
+            flask_phpbb3.backends.psycopg2.Psycopg2Backend._session_columns(
+                {'SESSION_COLUMNS': ['group_id', 'username']}
+            ),
+            's.*, u.user_id, u.username, u.group_id',
+        )
+
+    def test_invalid(self):
+        # type: () -> None
+        self.assertRaises(
+            ValueError,
+            flask_phpbb3.backends.psycopg2.Psycopg2Backend._session_columns,
+            {'SESSION_COLUMNS': ['user_id; DROP TABLE phpbb_users']},
+        )
+
+    def test_statement(self):
+        # type: () -> None
+        statements = flask_phpbb3.backends.psycopg2.Psycopg2Backend\
+            .create_registry({
+                'TABLE_PREFIX': 'phpbb_',
+                'SESSION_COLUMNS': ['group_id'],
+            })
+
+        self.assertTrue(
+            statements['get_session'].query.startswith(
+                'SELECT s.*, u.user_id, u.username, u.group_id FROM'
+            )
+        )
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': '',
+                'ITERSIZE': 100,
+                'CUSTOM_STATEMENTS': {
+                    'fetch_members': 'SELECT * FROM users',
+                },
+            },
+        )
+
+    def test_main(self, mocked_db):
+        # type: (mock.Mock) -> None
+        self.connection._connection = mocked_db
+        cursor = mocked_db.cursor.return_value
+        cursor.description = [('user_id',)]
+        cursor.__iter__ = mock.Mock(return_value=iter([(1,), (2,)]))
+
+        rows = self.connection.stream('fetch_members', skip=5)
+        self.assertTrue(
+            mocked_db.cursor.call_args[0][0].startswith('phpbb3_stream_')
+        )
+        self.assertEqual(cursor.itersize, 100)
+        cursor.execute.assert_called_once_with(
+            'SELECT * FROM users OFFSET %(_skip)s LIMIT %(_limit)s',
+            {'_skip': 5, '_limit': None},
+        )
+
+        self.assertEqual(list(rows), [{'user_id': 1}, {'user_id': 2}])
+        cursor.close.assert_called_once_with()
+
+    def test_closed_early(self, mocked_db):
+        # type: (mock.Mock) -> None
+        self.connection._connection = mocked_db
+        cursor = mocked_db.cursor.return_value
+        cursor.description = [('user_id',)]
+        cursor.__iter__ = mock.Mock(return_value=iter([(1,), (2,)]))
+
+        rows = self.connection.stream('fetch_members')
+        next(rows)
+        rows.close()
+
+        cursor.close.assert_called_once_with()
+
+    def test_backend_closed(self, mocked_db):
+        # type: (mock.Mock) -> None
+        cursor = mocked_db.cursor.return_value
+        cursor.__iter__ = mock.Mock(return_value=iter([(1,), (2,)]))
+
+        rows = self.connection.stream('fetch_members')
+        # App context was torn down before response was streamed
+        self.connection._connection = None
+
+        with self.assertRaises(psycopg2.InterfaceError):
+            next(rows)
+        self.assertEqual(mocked_db.cursor.call_count, 1)
+        cursor.close.assert_not_called()
+
+    def test_execute_error(self, mocked_db):
+        # type: (mock.Mock) -> None
+        cursor = mocked_db.cursor.return_value
+        cursor.execute.side_effect = psycopg2.ProgrammingError()
+
+        with self.assertRaises(psycopg2.ProgrammingError):
+            self.connection.stream('fetch_members')
+        cursor.close.assert_called_once_with()
+
+    def test_not_fetch(self, mocked_db):
+        # type: (mock.Mock) -> None
+        self.assertRaises(
+            ValueError,
+            self.connection.stream,
+            'get_user',
+            user_id=2,
+        )
+        self.assertRaises(
+            ValueError,
+            self.connection.stream,
+            'fetch_unknown',
+        )
+
+
+@mock.patch(
+    'flask_phpbb3.backends.psycopg2.Psycopg2Backend._execute_operation'
+)
+class TestFetchPage(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': '',
+                'CUSTOM_STATEMENTS': {
+                    'fetch_members': (
+                        'SELECT * FROM users WHERE group_id = %(group_id)s'
+                    ),
+                },
+            },
+        )
+        self.statement = self.connection._functions['fetch_members']
+
+    def test_first_page(self, mocked_execute_operation):
+        # type: (mock.Mock) -> None
+        self.connection._fetch_page(
+            self.statement,
+            'user_id',
+            {'group_id': 2},
+            False,
+            None,
+            10,
+        )
+
+        mocked_execute_operation.assert_called_once_with(
+            'fetch',
+            'SELECT * FROM ('
+            'SELECT * FROM users WHERE group_id = %(group_id)s'
+            ') AS page ORDER BY page.user_id LIMIT %(_limit)s',
+            {'group_id': 2, '_after': None, '_limit': 10},
+        )
+
+    def test_after(self, mocked_execute_operation):
+        # type: (mock.Mock) -> None
+        self.connection._fetch_page(
+            self.statement,
+            'user_id',
+            {'group_id': 2},
+            True,
+            7,
+            10,
+        )
+
+        mocked_execute_operation.assert_called_once_with(
+            'fetch',
+            'SELECT * FROM ('
+            'SELECT * FROM users WHERE group_id = %(group_id)s'
+            ') AS page WHERE page.user_id > %(_after)s'
+            ' ORDER BY page.user_id LIMIT %(_limit)s',
+            {'group_id': 2, '_after': 7, '_limit': 10},
+        )
+
+    def test_invalid_key(self, mocked_execute_operation):
+        # type: (mock.Mock) -> None
+        self.assertRaises(
+            ValueError,
+            self.connection._fetch_page,
+            self.statement,
+            'user_id; DROP TABLE users',
+            {},
+            False,
+            None,
+            10,
+        )
+        mocked_execute_operation.assert_not_called()
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
+class TestMemoize(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.config = {
+            'TABLE_PREFIX': 'phpbb_',
+            'CUSTOM_USER_FIELDS': ['some_field'],
+        }
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            self.config,
+        )
+        self.cursor = mock.Mock()
+        self.cursor.description = [('user_id',)]
+        self.cursor.fetchone.return_value = (2,)
+
+    def test_read(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+
+        for _ in range(2):
+            actual_value = self.connection.execute('get_user', user_id=2)
+            self.assertEqual(actual_value, {'user_id': 2})
+        self.assertEqual(self.cursor.execute.call_count, 1)
+
+        self.connection.execute('get_user', user_id=3)
+        self.assertEqual(self.cursor.execute.call_count, 2)
+
+    def test_copied(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+        self.cursor.__iter__ = mock.Mock(return_value=iter([(2,)]))
+
+        user = self.connection.execute('get_user', user_id=2)
+        user['user_id'] = 3
+        self.assertEqual(
+            self.connection.execute('get_user', user_id=2),
+            {'user_id': 2},
+        )
+
+        users = self.connection.execute('fetch_bots', limit=None)
+        users[0]['user_id'] = 3
+        users.append({'user_id': 4})
+        self.assertEqual(
+            self.connection.execute('fetch_bots', limit=None),
+            [{'user_id': 2}],
+        )
+        self.assertEqual(self.cursor.execute.call_count, 2)
+
+    def test_write(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+
+        self.connection.execute('get_user', user_id=2)
+        self.connection.execute('set_some_field', user_id=2, value='a')
+        self.connection.execute('get_user', user_id=2)
+
+        self.assertEqual(self.cursor.execute.call_count, 3)
+
+    def test_invalidate(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+
+        self.connection.execute('get_user', user_id=2)
+        self.connection.invalidate('get_user', user_id=2)
+        self.connection.execute('get_user', user_id=2)
+
+        self.assertEqual(self.cursor.execute.call_count, 2)
+
+    def test_close(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+
+        self.connection.execute('get_user', user_id=2)
+        self.connection.close()
+        self.connection.execute('get_user', user_id=2)
+
+        self.assertEqual(self.cursor.execute.call_count, 2)
+
+    def test_disabled(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+        self.config['MEMOIZE'] = False
+
+        for _ in range(2):
+            self.connection.execute('get_user', user_id=2)
+        self.assertEqual(self.cursor.execute.call_count, 2)
+
+    def test_datetime_argument(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+
+        user_regdate = datetime.datetime(2020, 1, 1)
+        for _ in range(2):
+            self.connection.execute('get_user', user_id=user_regdate)
+        self.assertEqual(self.cursor.execute.call_count, 1)
+
+    def test_unsupported_argument(self, mocked_db):
+        # type: (mock.Mock) -> None
+        mocked_db.cursor.return_value = self.cursor
+
+        user_id = object()
+        for _ in range(2):
+            self.connection.execute('get_user', user_id=user_id)
+        self.assertEqual(self.cursor.execute.call_count, 2)
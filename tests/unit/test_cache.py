@@ -0,0 +1,252 @@
+from __future__ import absolute_import
+
+import datetime
+import decimal
+import unittest
+import uuid
+
+import flask_phpbb3.cache
+
+import mock
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.cache = flask_phpbb3.cache.LocalCache(max_size=2)
+
+    def test_get_set(self):
+        # type: () -> None
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.get('key', 'default'), 'default')
+
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertIn('key', self.cache)
+
+    def test_delete(self):
+        # type: () -> None
+        self.cache.set('key', 'value')
+        self.cache.delete('key')
+        self.cache.delete('unknown')
+
+        self.assertNotIn('key', self.cache)
+
+    def test_eviction(self):
+        # type: () -> None
+        self.cache.set('first', 1)
+        self.cache.set('second', 2)
+
+        # Use first, so second is evicted
+        self.cache.get('first')
+        self.cache.set('third', 3)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn('first', self.cache)
+        self.assertNotIn('second', self.cache)
+        self.assertIn('third', self.cache)
+
+    @mock.patch('flask_phpbb3.cache.time.time')
+    def test_ttl(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        self.cache.set('key', 'value', ttl=10)
+        self.cache.set('forever', 'value')
+
+        mocked_time.return_value = 109
+        self.assertEqual(self.cache.get('key'), 'value')
+
+        mocked_time.return_value = 110
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.get('forever'), 'value')
+
+
+class TestKeyLocks(unittest.TestCase):
+    def test_cleanup(self):
+        # type: () -> None
+        locks = flask_phpbb3.cache.KeyLocks()
+
+        with locks.lock('key'):
+            with locks.lock('other_key'):
+                self.assertEqual(len(locks), 2)
+        self.assertEqual(len(locks), 0)
+
+    def test_non_blocking(self):
+        # type: () -> None
+        locks = flask_phpbb3.cache.KeyLocks()
+
+        with locks.lock('key') as locked:
+            self.assertTrue(locked)
+            with locks.lock('key', blocking=False) as other_locked:
+                self.assertFalse(other_locked)
+        self.assertEqual(len(locks), 0)
+
+        with locks.lock('key', blocking=False) as locked:
+            self.assertTrue(locked)
+
+    def test_release_on_error(self):
+        # type: () -> None
+        locks = flask_phpbb3.cache.KeyLocks()
+
+        with self.assertRaises(ValueError):
+            with locks.lock('key'):
+                raise ValueError()
+        self.assertEqual(len(locks), 0)
+
+
+class TestMakeKey(unittest.TestCase):
+    def test_order(self):
+        # type: () -> None
+        self.assertEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': 1, 'b': 'c'}),
+            'get_x:a=i1,b=s1:c',
+        )
+        self.assertEqual(
+            flask_phpbb3.cache.make_key('get_x', {'b': 'c', 'a': 1}),
+            'get_x:a=i1,b=s1:c',
+        )
+
+    def test_types(self):
+        # type: () -> None
+        keys = set([
+            flask_phpbb3.cache.make_key('get_x', {'a': 1}),
+            flask_phpbb3.cache.make_key('get_x', {'a': '1'}),
+            flask_phpbb3.cache.make_key('get_x', {'a': True}),
+            flask_phpbb3.cache.make_key('get_x', {'a': 1.0}),
+            flask_phpbb3.cache.make_key('get_x', {'a': None}),
+            flask_phpbb3.cache.make_key('get_x', {'a': [1]}),
+        ])
+        self.assertEqual(len(keys), 6)
+
+        self.assertEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': b'abc'}),
+            flask_phpbb3.cache.make_key('get_x', {'a': u'abc'}),
+        )
+
+    def test_repr_types(self):
+        # type: () -> None
+        values = [
+            datetime.datetime(2020, 1, 1),
+            datetime.date(2020, 1, 1),
+            datetime.timedelta(days=1),
+            decimal.Decimal('1.5'),
+            uuid.UUID(int=1),
+        ]
+        keys = set(
+            flask_phpbb3.cache.make_key('get_x', {'a': value})
+            for value in values
+        )
+        self.assertEqual(len(keys), len(values))
+        self.assertEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': decimal.Decimal('1')}),
+            'get_x:a=r20:Decimal:Decimal(\'1\')',
+        )
+        self.assertNotEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': decimal.Decimal('1')}),
+            flask_phpbb3.cache.make_key('get_x', {'a': 1}),
+        )
+
+    def test_dict(self):
+        # type: () -> None
+        self.assertEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': {'c': 2, 'b': 1}}),
+            'get_x:a=d2:s1:b=i1,s1:c=i2',
+        )
+        self.assertEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': {'b': 1, 'c': 2}}),
+            flask_phpbb3.cache.make_key('get_x', {'a': {'c': 2, 'b': 1}}),
+        )
+
+    def test_collisions(self):
+        # type: () -> None
+        self.assertNotEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': 'b,c=s1:d'}),
+            flask_phpbb3.cache.make_key('get_x', {'a': 'b', 'c': 'd'}),
+        )
+
+    def test_version(self):
+        # type: () -> None
+        self.assertEqual(
+            flask_phpbb3.cache.make_key('get_x', {'a': 1}, 'abcd'),
+            'get_x:abcd:a=i1',
+        )
+
+    def test_hashed(self):
+        # type: () -> None
+        long_key = flask_phpbb3.cache.make_key('get_x', {'a': 'a' * 500})
+        self.assertLessEqual(
+            len(long_key),
+            flask_phpbb3.cache.MAX_KEY_LENGTH,
+        )
+        self.assertTrue(long_key.startswith('get_x:h'))
+
+        unsafe_key = flask_phpbb3.cache.make_key('get_x', {'a': u'a b\u010d'})
+        self.assertTrue(unsafe_key.startswith('get_x:h'))
+        self.assertNotEqual(
+            unsafe_key,
+            flask_phpbb3.cache.make_key('get_x', {'a': u'a b'}),
+        )
+
+    def test_unsupported(self):
+        # type: () -> None
+        with self.assertRaises(TypeError):
+            flask_phpbb3.cache.make_key('get_x', {'a': object()})
+
+
+class TestSerializer(unittest.TestCase):
+    def test_pickle(self):
+        # type: () -> None
+        serializer = flask_phpbb3.cache.Serializer('pickle')
+        value = {
+            'user_id': 2,
+            'user_regdate': datetime.datetime(2020, 1, 1),
+            'user_points': decimal.Decimal('1.5'),
+        }
+
+        self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+
+    def test_pickle_protocol(self):
+        # type: () -> None
+        # Payloads have to be readable by workers on other Python version
+        serializer = flask_phpbb3.cache.Serializer('pickle')
+        self.assertEqual(serializer.dumps({'user_id': 2})[:3], b'r\x80\x02')
+
+    def test_json(self):
+        # type: () -> None
+        serializer = flask_phpbb3.cache.Serializer('json')
+        value = [1, {'username': u'user'}]
+
+        self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+        with self.assertRaises(TypeError):
+            serializer.dumps(datetime.datetime(2020, 1, 1))
+
+    def test_compression(self):
+        # type: () -> None
+        serializer = flask_phpbb3.cache.Serializer(
+            'pickle',
+            compression='zlib',
+            compress_threshold=100,
+        )
+        small_value = 'a'
+        large_value = 'a' * 1000
+
+        self.assertTrue(serializer.dumps(small_value).startswith(b'r'))
+        data = serializer.dumps(large_value)
+        self.assertTrue(data.startswith(b'z'))
+        self.assertLess(len(data), 100)
+        self.assertEqual(serializer.loads(data), large_value)
+
+        # Changed settings can still read old payloads
+        other_serializer = flask_phpbb3.cache.Serializer('pickle')
+        self.assertEqual(other_serializer.loads(data), large_value)
+
+    def test_unsupported(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            flask_phpbb3.cache.Serializer('yaml')
+
+        with self.assertRaises(ValueError):
+            flask_phpbb3.cache.Serializer('pickle', compression='bz2')
+
+        with self.assertRaises(ValueError):
+            flask_phpbb3.cache.Serializer('pickle').loads(b'xgarbage')
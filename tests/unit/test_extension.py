@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+
+import unittest
+
+import flask
+
+import flask_phpbb3
+
+import mock
+
+
+class TestBackend(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.app = flask.Flask('test_app')
+        self.phpbb3 = flask_phpbb3.PhpBB3(self.app)
+
+    @mock.patch('flask_phpbb3.extension.PhpBB3._create_backend')
+    def test_reused(self, mocked_create_backend):
+        # type: (mock.Mock) -> None
+        backend = mocked_create_backend.return_value
+        backend.is_closed = False
+
+        with self.app.app_context():
+            self.assertIs(self.phpbb3._backend, backend)
+            self.assertIs(self.phpbb3._backend, backend)
+
+        mocked_create_backend.assert_called_once()
+
+    @mock.patch('flask_phpbb3.extension.PhpBB3._create_backend')
+    def test_closed_replaced(self, mocked_create_backend):
+        # type: (mock.Mock) -> None
+        closed_backend = mock.Mock(is_closed=True)
+        backend = mock.Mock(is_closed=False)
+        mocked_create_backend.side_effect = [closed_backend, backend]
+
+        with self.app.app_context():
+            self.assertIs(self.phpbb3._backend, closed_backend)
+            self.assertIs(self.phpbb3._backend, backend)
+
+            # Old connection is handed back to the pool
+            closed_backend.close.assert_called_once_with()
+            backend.close.assert_not_called()
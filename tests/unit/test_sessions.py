@@ -1,8 +1,11 @@
 from __future__ import absolute_import
 
 import hashlib
+import json
 import unittest
 
+import flask
+
 import flask_phpbb3.sessions
 
 import mock
@@ -229,6 +232,19 @@ class TestSessionUserPrivileges(TestSession):
             forum_id=forum_id,
         )
 
+    def test_call_forums_with_privilege(self, mocked_phpbb3):
+        # type: (mock.Mock) -> None
+        user_acl = mock.Mock()
+        mocked_phpbb3.get_user_acl.return_value = user_acl
+
+        self.session.forums_with_privilege('f_read', 'f_post')
+
+        mocked_phpbb3.get_user_acl.assert_called_once_with('')
+        user_acl.forums_with_privilege.assert_called_once_with(
+            'f_read',
+            'f_post',
+        )
+
 
 @mock.patch('flask_phpbb3.sessions.PhpBB3Session._phpbb3')
 class TestUnreadNotificationsNum(TestSession):
@@ -268,3 +284,433 @@ class TestUnreadNotificationsNum(TestSession):
         mocked_phpbb3.get_unread_notifications_count.assert_called_once_with(
             user_id=user_id,
         )
+
+
+@mock.patch('flask_phpbb3.sessions.time.time', return_value=1000)
+class TestSessionInterfaceGetSession(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.app = flask.Flask('test_app')
+        self.app.config['PHPBB3_SESSION_BACKEND'] = {
+            'SESSION_LENGTH': 3600,
+            'SESSION_CACHE_TTL': 0,
+            'LOCAL_SESSION_CACHE_TTL': 0,
+            'UNKNOWN_SESSION_CACHE_TTL': 0,
+        }
+        self.phpbb3 = mock.Mock()
+        self.interface = flask_phpbb3.sessions.PhpBB3SessionInterface()
+
+    def test_uncached(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.phpbb3.get_session.return_value = {
+            'session_id': 'sid',
+            'username': b'user',
+        }
+
+        actual_result = self.interface._get_session(
+            self.app,
+            self.phpbb3,
+            'sid',
+        )
+
+        self.assertEqual(actual_result['username'], u'user')
+        self.phpbb3.get_session.assert_called_once_with(session_id='sid')
+
+    def test_local(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.app.config['PHPBB3_SESSION_BACKEND']['LOCAL_SESSION_CACHE_TTL'] =\
+            10
+        self.phpbb3.get_session.return_value = {
+            'session_id': 'sid',
+            'session_time': 900,
+        }
+
+        for _ in range(2):
+            actual_result = self.interface._get_session(
+                self.app,
+                self.phpbb3,
+                'sid',
+            )
+            self.assertEqual(actual_result['session_id'], 'sid')
+
+        self.phpbb3.get_session.assert_called_once_with(session_id='sid')
+
+    def test_shared(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.app.config['PHPBB3_SESSION_BACKEND']['SESSION_CACHE_TTL'] = 60
+        self.phpbb3.get_session.return_value = {
+            'session_id': 'sid',
+            'session_time': 900,
+        }
+
+        self.interface._get_session(self.app, self.phpbb3, 'sid')
+
+        self.phpbb3.get_session.assert_called_once_with(
+            session_id='sid',
+            cache=True,
+            cache_ttl=60,
+        )
+        self.phpbb3.invalidate.assert_not_called()
+
+    def test_stale_session_time(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.app.config['PHPBB3_SESSION_BACKEND']['SESSION_CACHE_TTL'] = 60
+        self.app.config['PHPBB3_SESSION_BACKEND']['LOCAL_SESSION_CACHE_TTL'] =\
+            10
+        self.phpbb3.get_session.side_effect = [{
+            'session_id': 'sid',
+            'session_time': -3000,
+        }, {
+            'session_id': 'sid',
+            'session_time': 990,
+        }]
+
+        actual_result = self.interface._get_session(
+            self.app,
+            self.phpbb3,
+            'sid',
+        )
+
+        self.assertEqual(actual_result['session_time'], 990)
+        self.phpbb3.invalidate.assert_called_once_with(
+            'get_session',
+            session_id='sid',
+        )
+        self.assertEqual(self.phpbb3.get_session.call_count, 2)
+
+    def test_invalidate(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.app.config['PHPBB3_SESSION_BACKEND']['LOCAL_SESSION_CACHE_TTL'] =\
+            10
+        self.app.phpbb3 = self.phpbb3
+        self.phpbb3.get_session.return_value = {'session_id': 'sid'}
+
+        self.interface._get_session(self.app, self.phpbb3, 'sid')
+        self.interface.invalidate_session(self.app, 'sid')
+        self.interface._get_session(self.app, self.phpbb3, 'sid')
+
+        self.assertEqual(self.phpbb3.get_session.call_count, 2)
+        self.phpbb3.invalidate.assert_called_once_with(
+            'get_session',
+            session_id='sid',
+        )
+
+    def test_unknown(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.app.config['PHPBB3_SESSION_BACKEND'][
+            'UNKNOWN_SESSION_CACHE_TTL'
+        ] = 10
+        self.phpbb3.get_session.return_value = None
+
+        for _ in range(2):
+            actual_result = self.interface._get_session(
+                self.app,
+                self.phpbb3,
+                'sid',
+            )
+            self.assertIsNone(actual_result)
+
+        self.phpbb3.get_session.assert_called_once_with(session_id='sid')
+
+    def test_unknown_disabled(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.phpbb3.get_session.return_value = None
+
+        for _ in range(2):
+            self.interface._get_session(self.app, self.phpbb3, 'sid')
+
+        self.assertEqual(self.phpbb3.get_session.call_count, 2)
+
+
+class TestBotMatcher(unittest.TestCase):
+    def test_prefixes(self):
+        # type: () -> None
+        matcher = flask_phpbb3.sessions.BotMatcher(['Googlebot', 'Bing.*'])
+
+        self.assertTrue(matcher.match('Googlebot/2.1'))
+        self.assertTrue(matcher.match('Bing.*bot'))
+        self.assertFalse(matcher.match('Bingbot'))
+        self.assertFalse(matcher.match('Mozilla/5.0 (Googlebot)'))
+        self.assertFalse(matcher.match('googlebot'))
+
+    def test_agents(self):
+        # type: () -> None
+        matcher = flask_phpbb3.sessions.BotMatcher([], ['Googlebot', 'Ya*x'])
+
+        self.assertTrue(matcher.match('Mozilla/5.0 (googlebot/2.1)'))
+        self.assertTrue(matcher.match('Mozilla/5.0 (Yandex)'))
+        self.assertFalse(matcher.match('Mozilla/5.0 (Yahoo)'))
+
+    def test_empty(self):
+        # type: () -> None
+        matcher = flask_phpbb3.sessions.BotMatcher([])
+
+        self.assertFalse(matcher.match(''))
+        self.assertFalse(matcher.match('Googlebot'))
+
+    def test_verdict_cached(self):
+        # type: () -> None
+        matcher = flask_phpbb3.sessions.BotMatcher(['Googlebot'])
+        matcher._prefix_pattern = mock.Mock(
+            wraps=matcher._prefix_pattern,
+        )
+
+        for _ in range(2):
+            self.assertTrue(matcher.match('Googlebot/2.1'))
+        matcher._prefix_pattern.match.assert_called_once_with('Googlebot/2.1')
+
+
+class TestSessionInterfaceBotMatcher(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.app = flask.Flask('test_app')
+        self.app.config['PHPBB3_BOTLIST'] = ['Googlebot']
+        self.app.config['PHPBB3_BOTLIST_DATABASE'] = False
+        self.app.phpbb3 = mock.Mock()
+        self.app.phpbb3.execute_custom.return_value = [
+            {'bot_agent': 'Yandex'},
+        ]
+        self.interface = flask_phpbb3.sessions.PhpBB3SessionInterface()
+
+    def test_rebuilt_on_change(self):
+        # type: () -> None
+        matcher = self.interface._get_bot_matcher(self.app)
+        self.assertIs(self.interface._get_bot_matcher(self.app), matcher)
+
+        self.app.config['PHPBB3_BOTLIST'].append('Bingbot')
+        matcher = self.interface._get_bot_matcher(self.app)
+        self.assertTrue(matcher.match('Bingbot'))
+        self.app.phpbb3.execute_custom.assert_not_called()
+
+    def test_tuple(self):
+        # type: () -> None
+        self.app.config['PHPBB3_BOTLIST'] = ('Googlebot', 'Bingbot')
+
+        matcher = self.interface._get_bot_matcher(self.app)
+        self.assertIs(self.interface._get_bot_matcher(self.app), matcher)
+
+    @mock.patch('flask_phpbb3.sessions.time.time')
+    def test_database(self, mocked_time):
+        # type: (mock.Mock) -> None
+        self.app.config['PHPBB3_BOTLIST_DATABASE'] = True
+        mocked_time.return_value = 1000
+
+        matcher = self.interface._get_bot_matcher(self.app)
+        self.assertTrue(matcher.match('Mozilla/5.0 (Yandex)'))
+        self.assertTrue(matcher.match('Googlebot'))
+        self.assertIs(self.interface._get_bot_matcher(self.app), matcher)
+        self.app.phpbb3.execute_custom.assert_called_once_with(
+            'fetch_bots',
+            cache=True,
+            cache_ttl=flask_phpbb3.sessions.BOTLIST_CACHE_TTL,
+            limit=None,
+        )
+
+        # Reloaded once in a while, same bots keep the same matcher
+        mocked_time.return_value += flask_phpbb3.sessions\
+            .BOTLIST_REFRESH_INTERVAL
+        self.assertIs(self.interface._get_bot_matcher(self.app), matcher)
+        self.assertEqual(self.app.phpbb3.execute_custom.call_count, 2)
+
+
+class TestLazySession(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        def load(session):
+            # type: (flask_phpbb3.sessions.PhpBB3Session) -> None
+            session._read_only_properties = set(['user_id'])
+            session.update({'user_id': 2})
+
+        self.loader = mock.Mock(side_effect=load)
+        self.session = flask_phpbb3.sessions.LazyPhpBB3Session(self.loader)
+
+    def test_not_loaded(self):
+        # type: () -> None
+        self.assertFalse(self.session.is_loaded)
+        self.assertFalse(self.session.modified)
+        self.loader.assert_not_called()
+
+    def test_accessors(self):
+        # type: () -> None
+        accessors = (
+            lambda session: session['user_id'],
+            lambda session: session.get('user_id'),
+            lambda session: 'user_id' in session,
+            lambda session: list(session.items()),
+            lambda session: len(session),
+            lambda session: session.is_authenticated,
+        )
+        for accessor in accessors:
+            self.setUp()
+            accessor(self.session)
+
+            self.assertTrue(self.session.is_loaded)
+            self.loader.assert_called_once_with(self.session._session)
+
+    def test_loaded_once(self):
+        # type: () -> None
+        self.assertEqual(self.session['user_id'], 2)
+        self.assertTrue(self.session.is_authenticated)
+        self.assertEqual(dict(self.session), {'user_id': 2})
+
+        self.loader.assert_called_once_with(self.session._session)
+
+    def test_dict(self):
+        # type: () -> None
+        self.assertEqual(dict(self.session), {'user_id': 2})
+
+    def test_json(self):
+        # type: () -> None
+        # Not a dict, so it is never serialized as an empty one
+        with self.assertRaises(TypeError):
+            json.dumps(self.session)
+
+        self.assertEqual(
+            json.loads(json.dumps(self.session, default=dict)),
+            {'user_id': 2},
+        )
+
+    def test_keyword_arguments(self):
+        # type: () -> None
+        self.assertEqual((lambda **kwargs: kwargs)(**self.session), {
+            'user_id': 2,
+        })
+
+    def test_set(self):
+        # type: () -> None
+        self.session['user_id'] = 3
+        self.assertFalse(self.session.modified)
+
+        self.session['some_key'] = 'value'
+        self.assertTrue(self.session.modified)
+        self.assertEqual(self.session, {'user_id': 3, 'some_key': 'value'})
+
+
+class TestSessionInterfaceOpenSession(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.app = flask.Flask('test_app')
+        self.app.config['PHPBB3_SESSION_BACKEND'] = {'LAZY': False}
+        self.app.phpbb3 = mock.Mock()
+        self.request = mock.Mock()
+        self.interface = flask_phpbb3.sessions.PhpBB3SessionInterface()
+
+    @mock.patch(
+        'flask_phpbb3.sessions.PhpBB3SessionInterface._load_session'
+    )
+    def test_eager(self, mocked_load_session):
+        # type: (mock.Mock) -> None
+        session = self.interface.open_session(self.app, self.request)
+
+        self.assertNotIsInstance(
+            session,
+            flask_phpbb3.sessions.LazyPhpBB3Session,
+        )
+        mocked_load_session.assert_called_once_with(
+            self.app,
+            self.request,
+            session,
+        )
+
+    @mock.patch(
+        'flask_phpbb3.sessions.PhpBB3SessionInterface._load_session'
+    )
+    def test_lazy(self, mocked_load_session):
+        # type: (mock.Mock) -> None
+        self.app.config['PHPBB3_SESSION_BACKEND']['LAZY'] = True
+
+        session = self.interface.open_session(self.app, self.request)
+        mocked_load_session.assert_not_called()
+
+        'user_id' in session
+        mocked_load_session.assert_called_once_with(
+            self.app,
+            self.request,
+            session._session,
+        )
+
+
+@mock.patch('flask_phpbb3.cache.time.time')
+class TestSessionInterfaceAnonymousUser(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.phpbb3 = mock.Mock()
+        self.phpbb3.get_user.return_value = {'user_id': 1, 'username': 'A'}
+        self.interface = flask_phpbb3.sessions.PhpBB3SessionInterface()
+
+    def test_memoized(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        user, keys = self.interface._get_anonymous_user(self.phpbb3)
+        self.assertEqual(user, {'user_id': 1, 'username': 'A'})
+        self.assertEqual(keys, frozenset(['user_id', 'username']))
+
+        self.assertIs(self.interface._get_anonymous_user(self.phpbb3)[0], user)
+        self.phpbb3.get_user.assert_called_once_with(
+            user_id=1,
+            cache=True,
+            cache_ttl=flask_phpbb3.sessions.ANONYMOUS_CACHE_TTL,
+        )
+
+        mocked_time.return_value += flask_phpbb3.sessions\
+            .LOCAL_ANONYMOUS_CACHE_TTL
+        self.interface._get_anonymous_user(self.phpbb3)
+        self.assertEqual(self.phpbb3.get_user.call_count, 2)
+
+    def test_missing(self, mocked_time):
+        # type: (mock.Mock) -> None
+        mocked_time.return_value = 100
+        self.phpbb3.get_user.return_value = None
+
+        for _ in range(2):
+            self.assertEqual(
+                self.interface._get_anonymous_user(self.phpbb3),
+                ({}, frozenset()),
+            )
+        self.assertEqual(self.phpbb3.get_user.call_count, 2)
+
+
+@mock.patch('flask_phpbb3.sessions.PhpBB3Session._phpbb3')
+class TestSessionPartial(TestSession):
+    def setUp(self):
+        # type: () -> None
+        super(TestSessionPartial, self).setUp()
+
+        self.app = flask.Flask('test_app')
+        self.app.config['PHPBB3_SESSION_BACKEND'] = {'SESSION_CACHE_TTL': 0}
+        self.session._read_only_properties = set(['user_id', 'username'])
+        self.session.update({'user_id': 2, 'username': 'user'})
+        self.session._partial = True
+
+    def test_load_missing(self, mocked_phpbb3):
+        # type: (mock.Mock) -> None
+        mocked_phpbb3.get_user.return_value = {
+            'user_id': 2,
+            'username': 'other',
+            'user_permissions': 'HRA0HS',
+        }
+
+        with self.app.app_context():
+            self.assertEqual(self.session['user_permissions'], 'HRA0HS')
+            self.assertEqual(self.session['username'], 'user')
+            self.assertRaises(KeyError, lambda: self.session['unknown'])
+
+        mocked_phpbb3.get_user.assert_called_once_with(
+            user_id=2,
+            cache=False,
+            cache_ttl=0,
+        )
+        self.assertFalse(self.session.modified)
+        self.assertIn('user_permissions', self.session._read_only_properties)
+
+    def test_get(self, mocked_phpbb3):
+        # type: (mock.Mock) -> None
+        self.assertIsNone(self.session.get('user_permissions'))
+        mocked_phpbb3.get_user.assert_not_called()
+
+    def test_complete(self, mocked_phpbb3):
+        # type: (mock.Mock) -> None
+        self.session._partial = False
+
+        self.assertRaises(KeyError, lambda: self.session['user_permissions'])
+        mocked_phpbb3.get_user.assert_not_called()